@@ -1,132 +1,645 @@
 def Page1():
 
     import streamlit as st
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
     import pandas as pd
-    import xml.etree.ElementTree as ET
-    from io import BytesIO
     import json
     import os
-    from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode
+    from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode, GridUpdateMode
     from datetime import datetime, timedelta
+    from cache import ByteLRUCache
+    from diagnostics import Trace, activate, profiled, render_trace, write_json_lines
+    from integration import (
+        ROUNDING_COLUMNS, apply_cell_edits, build_sheets, build_value_table,
+        column_fingerprint, compact_sheet, export_xlsx, fill_create_times,
+        frame_memory_bytes, load_xml_batch,
+    )
+    from jobs import ACTIVE_STATES, CANCELLED, DONE, FAILED, QUEUED
+    from redaction import mapping_to_parquet
+    from resources import get_job_queue, get_session_registry, session_stores, touch_session
 
     # Инициализация состояния для excel_sheets
     if "excel_sheets" not in st.session_state:
         st.session_state["excel_sheets"] = {}
 
-    # Функция для парсинга XML
-    def parse_xml(file):
-        tree = ET.parse(file)
-        root = tree.getroot()
-
-        data = []
-        for sample in root.findall(".//SAMPLE"):
-            sample_name = sample.attrib.get("name", "")
-            create_time = sample.attrib.get("createtime", "")
-            for compound in sample.findall("COMPOUND"):
-                compound_name = compound.attrib.get("name", "")
-                for peak in compound.findall("PEAK"):
-                    response = peak.attrib.get("response", "")
-                    conc = peak.attrib.get("analconc", "")
-                    data.append({
-                        "Sample_name": sample_name,
-                        "Create_time": create_time,
-                        "Compound_name": compound_name,
-                        "Response": response,
-                        "Conc": conc
-                    })
-
-        df = pd.DataFrame(data)
-
-        df.sort_values(by=["Compound_name", "Sample_name"], inplace=True)
-        return df
-
+    @st.cache_resource
+    def get_xml_cache():
+        """
+        Общий для всех сессий кэш разобранных XML.
+
+        Объём задаётся переменной окружения EDIT_PDF_XML_CACHE_MB.
+        """
+        return ByteLRUCache(
+            max_bytes=int(os.environ.get("EDIT_PDF_XML_CACHE_MB", 256)) * 1024 * 1024
+        )
+
+    def record_trace(trace):
+        """
+        Сохраняет замеры прогона для раздела диагностики и дописывает их
+        в журнал JSON Lines из EDIT_PDF_TRACE_LOG.
+        """
+        write_json_lines(trace.finish(), os.environ.get("EDIT_PDF_TRACE_LOG"))
+        st.session_state.setdefault("page1_traces", {})[trace.name] = trace
 
     # Функция для загрузки JSON
     def load_json(file):
         return pd.DataFrame(json.load(file))
 
-    # Функция для извлечения кривых из XML
-    def extract_curves(file):
-        try:
-            file.seek(0)
-            tree = ET.parse(file)
-            root = tree.getroot()
-
-            data = {}
-            for compound in root.findall(".//CALIBRATIONDATA/COMPOUND"):
-                compound_name = compound.attrib.get("name", "")
-                calibration_curve = compound.find(".//CALIBRATIONCURVE")
-                if calibration_curve is not None:
-                    curve = calibration_curve.attrib.get("curve", "")
-                    data[compound_name] = curve
-
-            return data
-        except ET.ParseError as e:
-            raise ValueError(f"XML parsing error: {e}")
-        except Exception as e:
-            raise ValueError(f"Unexpected error: {e}")
-
-    # Функция для вычисления результата
-    def calculate_result(new_conc, curve):
-        try:
-            x = float(new_conc)
-            result = eval(curve.replace("x", str(x)))
-            return result
-        except Exception:
-            return ""
-
-    # Функция для округления значений
-    def apply_rounding(data, precision):
-        """Округляет значения в массиве данных и обеспечивает единообразный формат вывода."""
-        def round_number(x):
-            try:
-                num = float(x)
-                return round(num, precision)
-            except ValueError:
-                return x
-
-        return [round_number(x) for x in data]
-
-    # Функция для применения разрядности (форматирование вывода как в Excel)
-    def apply_digits(data, digits):
-        """Применяет разрядность чисел, добавляя фиксированное количество знаков после запятой."""
-        def format_number(x):
-            try:
-                num = float(x)
-                return f"{num:.{digits}f}"
-            except ValueError:
-                return x
-
-        return [format_number(x) for x in data]
-    
     # Streamlit приложение
     st.title("XML & JSON Integration for Excel Export")
 
+    if touch_session():
+        st.info(
+            "Data of this session was released after a period of inactivity. "
+            "Upload the files again to continue."
+        )
+
     # Выбор режима работы
     mode = st.radio("Select mode:", ("Use curves from XML", "Manually specify coefficients"))
 
     uploaded_xml_files = st.file_uploader("Upload XML Files", type="xml", accept_multiple_files=True)
+    with st.expander("Processing options"):
+        xml_workers = st.number_input(
+            "Parallel processes for XML parsing", min_value=1, max_value=os.cpu_count() or 1,
+            value=1, step=1,
+            help="Processes are shared by all users of the server: if fewer are free, "
+                 "parsing runs with the free ones or in a single process.",
+        )
+        profile_export = st.checkbox(
+            "Profile exports with cProfile", key="page1_profile",
+            help="The report is shown in the Diagnostics section at the bottom of the page.",
+        )
+
+    # Этапы страницы связаны явными зависимостями: загрузка XML и JSON выполняется
+    # в основном проходе и повторяется только при смене файлов, а настройки,
+    # экспорт, редактор листов и номера страниц — отдельные фрагменты, которые
+    # перезапускаются сами по себе при работе с их виджетами.
+
+    @st.fragment
+    def rounding_settings_stage(compound):
+        """
+        Настройки округления и разрядности одного соединения.
+
+        Значения только сохраняются в сессии и читаются экспортом при нажатии
+        кнопки, поэтому изменение поля перезапускает лишь блок этого соединения.
+        """
+        touch_session()
+        # Инициализация сессии для округления
+        for col in ["response", "conc", "new_response", "new_conc"]:
+            if f"{col}_rounding_{compound}" not in st.session_state:
+                st.session_state[f"{col}_rounding_{compound}"] = 2  # Значение по умолчанию
+            if f"{col}_digits_{compound}" not in st.session_state:
+                st.session_state[f"{col}_digits_{compound}"] = 2  # Значение по умолчанию
+        
+        # Динамическое создание виджетов
+        with st.expander(f"Настройка округления и разрядности для {compound}"):
+             # Виджеты для округления
+             response_rounding = st.number_input(
+                 f"Округление для Response ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"response_rounding_{compound}"],
+                 step=1, key=f"key_response_rounding_{compound}"
+             )
+             conc_rounding = st.number_input(
+                 f"Округление для Conc ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"conc_rounding_{compound}"],
+                 step=1, key=f"key_conc_rounding_{compound}"
+             )
+             new_response_rounding = st.number_input(
+                 f"Округление для newResponse ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"new_response_rounding_{compound}"],
+                 step=1, key=f"key_new_response_rounding_{compound}"
+             )
+             new_conc_rounding = st.number_input(
+                 f"Округление для newConc ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"new_conc_rounding_{compound}"],
+                 step=1, key=f"key_new_conc_rounding_{compound}"
+             )
+
+             # Виджеты для разрядности
+             response_digits = st.number_input(
+                 f"Разрядность для Response ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"response_digits_{compound}"],
+                 step=1, key=f"key_response_digits_{compound}"
+             )
+             conc_digits = st.number_input(
+                 f"Разрядность для Conc ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"conc_digits_{compound}"],
+                 step=1, key=f"key_conc_digits_{compound}"
+             )
+             new_response_digits = st.number_input(
+                 f"Разрядность для newResponse ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"new_response_digits_{compound}"],
+                 step=1, key=f"key_new_response_digits_{compound}"
+             )
+             new_conc_digits = st.number_input(
+                 f"Разрядность для newConc ({compound})", min_value=0, max_value=10,
+                 value=st.session_state[f"new_conc_digits_{compound}"],
+                 step=1, key=f"key_new_conc_digits_{compound}"
+             )
+
+             # Обновляем значения в сессии
+             st.session_state[f"response_rounding_{compound}"] = response_rounding
+             st.session_state[f"conc_rounding_{compound}"] = conc_rounding
+             st.session_state[f"new_response_rounding_{compound}"] = new_response_rounding
+             st.session_state[f"new_conc_rounding_{compound}"] = new_conc_rounding
+
+             st.session_state[f"response_digits_{compound}"] = response_digits
+             st.session_state[f"conc_digits_{compound}"] = conc_digits
+             st.session_state[f"new_response_digits_{compound}"] = new_response_digits
+             st.session_state[f"new_conc_digits_{compound}"] = new_conc_digits
+
+    # Пока задание экспорта выполняется, фрагмент экспорта опрашивает очередь раз в секунду
+    export_job_id = st.session_state.get("page1_job")
+    export_job_status = get_job_queue().status(export_job_id) if export_job_id else None
+    export_job_active = export_job_status is not None and export_job_status["state"] in ACTIVE_STATES
+
+    @st.fragment(run_every=1 if export_job_active else None)
+    def export_stage(file_data, curves_dict, json_files, coefficients, mode):
+        """
+        Расчёт newConc/newResponse, округление и выгрузка книги Excel.
+
+        Расчёт выполняется фоновым заданием с входными данными, снятыми при
+        нажатии кнопки; фрагмент показывает его ход и по завершении переносит
+        листы и книгу в сессию. Новые листы нужны редактору и номерам страниц,
+        поэтому после переноса во время опроса страница перезапускается целиком.
+        """
+        touch_session()
+        queue = get_job_queue()
+        job_id = st.session_state.get("page1_job")
+        status = queue.status(job_id) if job_id else None
+
+        if status is not None and status["state"] == DONE:
+            st.session_state["excel_sheets"], st.session_state["page1_export"], trace = queue.result(job_id)
+            st.session_state.setdefault("page1_traces", {})[trace.name] = trace
+            queue.remove(job_id)
+            del st.session_state["page1_job"]
+            status = None
+            if export_job_active:
+                st.rerun()
+        elif status is not None and status["state"] not in ACTIVE_STATES and export_job_active:
+            # Опрос больше не нужен; ошибка или отмена показываются после перезапуска
+            st.rerun()
+
+        if status is not None and status["state"] in ACTIVE_STATES:
+            if status["state"] == QUEUED:
+                text = f"Export is queued, position {status['position']}"
+            else:
+                eta = status["eta_seconds"]
+                text = (
+                    f"{status['message'] or 'Processing'} — {status['done']} of {status['total']}"
+                    + (f", about {eta:.0f} s left" if eta is not None else "")
+                )
+            st.progress(min(status["done"] / status["total"], 1.0) if status["total"] else 0.0, text=text)
+            if st.button("Cancel export"):
+                queue.cancel(job_id)
+            return
+
+        if status is not None and status["state"] == FAILED:
+            st.error(f"Export failed: {status['error']}")
+        elif status is not None and status["state"] == CANCELLED:
+            st.info("Export was cancelled.")
+
+        if st.button("Process and Export to Excel"):
+            # Кривые соединений в выбранном режиме
+            curves = {}
+            for compound in json_files:
+                if mode == "Use curves from XML":
+                    curves[compound] = curves_dict.get(compound, "")
+                else:
+                    a, b = coefficients.get(compound, (0, 0))
+                    curves[compound] = f"{a}*x+{b}"
+
+            # Настройки округления и разрядности соединений из сессии одной таблицей
+            compounds_in_files = pd.unique(
+                pd.concat([df["Compound_name"] for df in file_data.values()], ignore_index=True)
+            ) if file_data else []
+            rounding_settings = pd.DataFrame(
+                {
+                    f"{prefix}_{kind}": [
+                        st.session_state.get(f"{prefix}_{kind}_{compound}", 2)
+                        for compound in compounds_in_files
+                    ]
+                    for prefix in ROUNDING_COLUMNS.values()
+                    for kind in ("rounding", "digits")
+                },
+                index=compounds_in_files,
+            )
+            spill_threshold = int(os.environ.get("EDIT_PDF_EXPORT_SPILL_MB", 50)) * 1024 * 1024
+            trace_log = os.environ.get("EDIT_PDF_TRACE_LOG")
+
+            def export_job(progress):
+                trace = Trace("page1.export", files=len(file_data), compounds=len(json_files))
+                with activate(trace), profiled(trace, profile_export):
+                    excel_sheets, messages = build_sheets(
+                        file_data, json_files, curves, rounding_settings, progress.advance
+                    )
+                    progress.advance(0, "Writing workbook")
+                    # Каждый лист записывается один раз, построчно; большая книга уходит на диск
+                    # и хранится в сессии файлом, в память читается только для кнопки скачивания
+                    output, export_stats = export_xlsx(excel_sheets.items(), spill_threshold=spill_threshold)
+                # Замеры пишутся в журнал из задания: сессия ему недоступна
+                write_json_lines(trace.finish(), trace_log)
+                progress.advance(1)
+                return excel_sheets, {
+                    "file": output, "on_disk": export_stats["output_bytes"] > spill_threshold,
+                    "stats": export_stats, "messages": messages,
+                }, trace
+
+            if job_id:
+                queue.remove(job_id)
+            st.session_state["page1_job"] = queue.submit(
+                export_job, total=len(file_data) * (len(json_files) + 1) + 1,
+                label="Process and Export to Excel",
+            )
+            st.rerun()
+
+        export = st.session_state.get("page1_export")
+        if export:
+            for message in export["messages"]:
+                st.warning(message)
+            export["file"].seek(0)
+            st.download_button(
+                label="Download Excel File",
+                data=export["file"].read(),
+                file_name="processed_data.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+            export_stats = export["stats"]
+            rss_growth = export_stats["rss_growth_bytes"]
+            rss_growth_text = f"{rss_growth / 1024 / 1024:.0f} MB" if rss_growth is not None else "n/a"
+            st.caption(
+                f"Export: {export_stats['export_seconds']:.2f} s, "
+                f"{export_stats['output_bytes'] / 1024:.0f} KB"
+                f"{' (kept on disk)' if export['on_disk'] else ''}, "
+                f"server memory growth while writing {rss_growth_text}"
+            )
+
+    def sheet_compounds(df):
+        """Соединения листа — то, от чего зависят поля номеров страниц."""
+        return tuple(df["Compound_name"].unique()) if "Compound_name" in df.columns else ()
+
+    def rerun_sheet_editor():
+        """
+        Перезапускает редактор листов, чтобы таблица получила новые данные.
+
+        Во время полного прохода перезапуск только фрагмента недоступен,
+        тогда перезапускается вся страница.
+        """
+        ctx = get_script_run_ctx()
+        st.rerun(scope="fragment" if ctx is not None and ctx.fragment_ids_this_run else "app")
+
+    @st.fragment
+    def sheet_editor_stage():
+        """
+        Просмотр и правка листов в AgGrid и пересчёт newCreate_time.
+
+        Правки меняют только выбранный лист в сессии и перезапускают этот
+        фрагмент. Страница перезапускается целиком, лишь если у листа изменился
+        набор соединений, от которого зависят поля номеров страниц.
+        """
+        touch_session()
+        st.subheader("View and Edit Excel Sheets")
+
+        # Выбор текущего листа
+        selected_sheet = st.selectbox("Select Sheet to View/Edit:", options=list(st.session_state["excel_sheets"].keys()))
+
+
+        # Получаем данные для текущего листа
+        df = st.session_state["excel_sheets"][selected_sheet]
+
+        # Постраничный режим: в таблицу уходит только видимое окно строк,
+        # а правки переносятся в лист в сессии по ячейкам, без замены листа
+        paginated = st.checkbox(
+            "Paginated editing (only the visible rows are sent to the grid)",
+            value=len(df) > 5000, key=f"paginated_{selected_sheet}"
+        )
+
+        if paginated:
+            # Окна и правки адресуются номерами строк
+            if not df.index.equals(pd.RangeIndex(len(df))):
+                df.reset_index(drop=True, inplace=True)
+
+            page_col1, page_col2 = st.columns(2)
+            with page_col1:
+                page_size = st.selectbox(
+                    "Rows per page", [100, 500, 1000, 5000], index=1,
+                    key=f"page_size_{selected_sheet}"
+                )
+            page_count = max(1, -(-len(df) // page_size))
+            with page_col2:
+                page_number = st.number_input(
+                    f"Page (of {page_count})", min_value=1, max_value=page_count, value=1,
+                    step=1, key=f"page_number_{selected_sheet}"
+                )
+            start = (page_number - 1) * page_size
+            window = df.iloc[start:start + page_size].reset_index(drop=True)
+
+            gb = GridOptionsBuilder.from_dataframe(window)
+            gb.configure_default_column(editable=True)  # Делаем все колонки редактируемыми
+            gb.configure_grid_options(enableRangeSelection=True)
+            gb.configure_grid_options(enableFullScreen=True)  # Включаем полноэкранный режим
+            grid_options = gb.build()
+
+            # Версия листа меняется, когда лист правится не из таблицы:
+            # таблица с новым ключом заново получает данные окна
+            sheet_versions = st.session_state.setdefault("sheet_versions", {})
+            grid_response = AgGrid(
+                window,
+                gridOptions=grid_options,
+                data_return_mode=DataReturnMode.AS_INPUT,
+                update_mode=GridUpdateMode.NO_UPDATE,
+                update_on=["cellValueChanged"],  # Ответ только после правки ячейки
+                fit_columns_on_grid_load=True,
+                enable_enterprise_modules=False,
+                editable=True,
+                key=f"grid_{selected_sheet}_{page_size}_{start}_{sheet_versions.get(selected_sheet, 0)}",
+            )
+            deltas = apply_cell_edits(df, grid_response.data, offset=start)
+            st.caption(
+                f"Rows {start + 1}–{min(start + page_size, len(df))} of {len(df)}"
+                + (f", {len(deltas)} cells updated" if deltas else "")
+            )
+        else:
+            # Настройка параметров AgGrid
+            gb = GridOptionsBuilder.from_dataframe(df)
+            gb.configure_default_column(editable=True)  # Делаем все колонки редактируемыми
+            gb.configure_grid_options(enableRangeSelection=True)
+            gb.configure_grid_options(enableFullScreen=True)  # Включаем полноэкранный режим
+            grid_options = gb.build()
+
+            # Отображаем таблицу с возможностью редактирования
+            grid_response = AgGrid(
+                df,
+                gridOptions=grid_options,
+                data_return_mode=DataReturnMode.FILTERED_AND_SORTED,
+                update_mode="MODEL_CHANGED",  # Автоматическое обновление данных при изменении
+                fit_columns_on_grid_load=True,
+                enable_enterprise_modules=False,
+                editable=True,
+            )
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+             #Обновление страницы путем ререндинга
+             if st.button("Update the table"):
+                st.query_params = {"rerun": "true"}
+
+        updated_df = df if paginated else pd.DataFrame(grid_response["data"])
+        
+        with col2:
+            #Очистка данных колонки newCreate_time
+            if st.button("Clear 'newCreate_time' column"):
+               if "newCreate_time" in updated_df.columns:
+                   updated_df["newCreate_time"] = ""  # Очищаем колонку
+                   st.session_state["excel_sheets"][selected_sheet] = compact_sheet(updated_df)
+                   if paginated:
+                       sheet_versions[selected_sheet] = sheet_versions.get(selected_sheet, 0) + 1
+                       rerun_sheet_editor()
+                   st.success("'newCreate_time' column has been cleared successfully!")
+               else:
+                   st.warning("'newCreate_time' column does not exist in the selected sheet.")
+        
+        # Обновляем данные в сессии
+        st.session_state["excel_sheets"][selected_sheet] = compact_sheet(updated_df)
+        st.success(f"Changes to sheet '{selected_sheet}' saved successfully!")
+
+        if not paginated:
+            updated_df = st.session_state["excel_sheets"][selected_sheet].reset_index(drop=True)
+
+        # Проверяем наличие колонок Create_time и newCreate_time
+        if "Create_time" in updated_df.columns and "newCreate_time" in updated_df.columns:
+            try:
+                # Проверяем, что значение в первой строке newCreate_time корректное
+
+                first_value = updated_df.loc[0, "newCreate_time"]
+
+                # Проверяем, не пустое ли значение и строковый ли тип
+                if isinstance(first_value, str) and len(first_value.split(":")) == 3:
+                    first_time = datetime.strptime(first_value, "%H:%M:%S")
+                    first_hour = first_time.hour
+                else:
+                    st.warning("The first value of 'newCreate_time' is not in a valid time format (HH:MM:SS). Update skipped.")
+                    first_time = None
+
+                # Выполняем обновление, только если значение корректное
+                if first_time:
+                    # Пересчитываем, только если изменились Create_time или первое значение,
+                    # либо колонка отличается от последнего результата (правка или очистка)
+                    time_state = st.session_state.setdefault("new_create_time_state", {})
+                    inputs = (first_value, column_fingerprint(updated_df["Create_time"]))
+                    previous = time_state.get(selected_sheet)
+                    if (
+                        previous is None
+                        or previous["inputs"] != inputs
+                        or previous["result"] != column_fingerprint(updated_df["newCreate_time"])
+                    ):
+                        updated_df["newCreate_time"], invalid_rows = fill_create_times(
+                            updated_df["Create_time"], updated_df["newCreate_time"], first_hour
+                        )
+                        previous = {
+                            "inputs": inputs,
+                            "result": column_fingerprint(updated_df["newCreate_time"]),
+                            "invalid_rows": invalid_rows,
+                        }
+                        time_state[selected_sheet] = previous
+                        if paginated:
+                            # Окно таблицы показывает старые значения колонки
+                            st.session_state["excel_sheets"][selected_sheet] = compact_sheet(updated_df)
+                            sheet_versions[selected_sheet] = sheet_versions.get(selected_sheet, 0) + 1
+                            rerun_sheet_editor()
+
+                    if previous["invalid_rows"]:
+                        rows = previous["invalid_rows"]
+                        st.warning(
+                            f"{len(rows)} rows have invalid time format in 'Create_time' "
+                            f"(in the row or the row before): "
+                            f"{', '.join(map(str, rows[:20]))}{'...' if len(rows) > 20 else ''}"
+                        )
+
+                    st.session_state["excel_sheets"][selected_sheet] = compact_sheet(updated_df)
+
+            except Exception as e:
+                st.error(f"Error while processing newCreate_time: {e}")
+        else:
+            st.warning("Columns 'Create_time' and/or 'newCreate_time' are missing. No updates applied.")
+
+        # Поля номеров страниц построены по соединениям листов; если правка
+        # изменила этот набор, их нужно перестроить вместе со всей страницей
+        rendered = st.session_state.get("page_inputs_compounds", {})
+        if sheet_compounds(st.session_state["excel_sheets"][selected_sheet]) != rendered.get(selected_sheet):
+            st.rerun()
+
+    @st.fragment
+    def page_inputs_stage(sheet_name, compound):
+        """
+        Номера страниц для одного соединения листа.
+
+        Значения читаются при создании таблиц замен, поэтому изменение поля
+        перезапускает только блок этого соединения.
+        """
+        touch_session()
+        # Создание словаря для хранения значений Page для каждого соединения
+        page_inputs = st.session_state["page_inputs"]
+
+        st.write(f"#### Compound: {compound}")
+        
+        
+        # Уникальные ключи для виджетов
+        key_newConc_newResponse  = f"newConc_newResponse _{sheet_name}_{compound}_value"
+        key_newCreate_time = f"newCreate_time_{sheet_name}_{compound}_value"
+        
+        # Инициализация значений виджетов
+        if key_newConc_newResponse not in st.session_state:
+            st.session_state[key_newConc_newResponse] = 1
+        if key_newCreate_time not in st.session_state:
+            st.session_state[key_newCreate_time] = 0
+
+        st.session_state[key_newConc_newResponse] = st.number_input(
+            f"Page for newConc and newResponse ({compound})", min_value=0, step=1, value=st.session_state[key_newConc_newResponse], key=f"key_{key_newConc_newResponse}"
+        )
+    
+        st.session_state[key_newCreate_time] = st.number_input(
+            f"Page for newCreate_time ({compound})", min_value=0, step=1, value=st.session_state[key_newCreate_time], key=f"key_{key_newCreate_time}"
+        )
+
+        # Сохраняем значения в сессию
+        page_inputs[(sheet_name, compound)] = {
+            "newConc_newResponse_page": st.session_state[key_newConc_newResponse],
+            "newCreate_time_page": st.session_state[key_newCreate_time],
+        }
+
+    def page_inputs_section():
+        """
+        Поля номеров страниц по соединениям каждого листа.
+
+        Набор соединений, по которому построены поля, сохраняется для
+        проверки редактором листов.
+        """
+        rendered = {}
+
+        # Динамическое создание виджетов
+        with st.expander("Номера страниц"):
+             for sheet_name, df in st.session_state["excel_sheets"].items():
+                 st.write(f"### Sheet: {sheet_name}")
+                 compounds = sheet_compounds(df)
+                 rendered[sheet_name] = compounds
+
+                 for compound in compounds:
+                     page_inputs_stage(sheet_name, compound)
+
+        st.session_state["page_inputs_compounds"] = rendered
+
+    @st.fragment
+    def value_tables_stage():
+        """
+        Таблицы Old Value / New Value / Page для страницы редактирования PDF.
+
+        Читает листы и номера страниц из сессии в момент нажатия кнопки;
+        другие этапы страницы от результата не зависят.
+        """
+        touch_session()
+        page_inputs = st.session_state["page_inputs"]
+
+        # Генерация нового файла Excel
+        archive_xlsx = st.checkbox("Also create an Excel file for the archive")
+        if st.button("Generate New Excel with Old and New Values"):
+            value_tables = {}
+            for sheet_name, df in st.session_state["excel_sheets"].items():
+                # Номера страниц для каждого соединения листа
+                pages = {
+                    compound: page_inputs[(sheet_name, compound)]
+                    for compound in df["Compound_name"].unique()
+                }
+                result_df = build_value_table(df, pages)
+
+                if result_df is not None:
+                    # Формируем название листа
+                    clean_sheet_name = f"{sheet_name.replace('.xml', '').replace('.', '_')}"[:31]  # Ограничение по длине имени листа
+                    value_tables[clean_sheet_name] = result_df
+
+            # Таблицы передаются на страницу редактирования PDF без записи в Excel
+            st.session_state["mapping_tables"] = {
+                name: mapping_to_parquet(result_df) for name, result_df in value_tables.items()
+            }
+            st.success(
+                f"{len(value_tables)} tables with Old and New Values are available "
+                f"on the PDF editing page."
+            )
+
+            if archive_xlsx:
+                # Применяем текстовый формат ко всем ячейкам
+                new_output, _ = export_xlsx(
+                    value_tables.items(), fit_widths=False, column_format={'num_format': '@'}
+                )
+                st.download_button(
+                    label="Download Filtered Excel File",
+                    data=new_output.read(),
+                    file_name="filtered_data.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                )
+                st.success("New Excel file generated successfully!")
+
     file_data = {}
     curves_dict = {}
     coefficients = {}
     compounds = set()
-    excel_sheets = {}
 
     if uploaded_xml_files:
-        for file in uploaded_xml_files:
-            try:
-                df = parse_xml(file)
-                file_data[file.name] = df
-            except Exception as e:
-                st.error(f"Error processing XML file {file.name}: {e}")
-
+        # Пики и кривые читаются за один проход по файлу, повторно — из кэша;
+        # результаты объединяются в порядке загрузки файлов. Пока набор файлов
+        # не изменился, перезапуски страницы берут готовый результат из сессии.
+        ingest_key = tuple(file.file_id for file in uploaded_xml_files)
+        ingest = st.session_state.get("page1_ingest")
+        if not ingest or ingest["key"] != ingest_key:
+            ingest = {"key": ingest_key, "file_data": {}, "curves": {}, "errors": []}
+            files = [(file.name, file.getvalue()) for file in uploaded_xml_files]
+            xml_cache = get_xml_cache()
+
+            def ingest_job(progress):
+                # Процессы разбора берутся из общего бюджета очереди заданий
+                with progress.reserve_processes(xml_workers) as processes:
+                    trace = Trace("page1.ingest", files=len(files), workers=processes)
+                    with activate(trace):
+                        batch = load_xml_batch(files, workers=processes, cache=xml_cache)
+                progress.advance(len(files))
+                return batch, trace
+
+            # Разбор идёт через очередь заданий, а страница ждёт его результата
+            queue = get_job_queue()
+            ingest_job_id = queue.submit(ingest_job, total=len(files), label="Parse XML files")
             try:
-                curves = extract_curves(file)
-                curves_dict.update(curves)
-            except ValueError as e:
-                st.error(f"Error extracting curves from XML file {file.name}: {e}")
-            except Exception as e:
-                st.error(f"Unexpected error with file {file.name}: {e}")
+                with st.spinner("Parsing XML files..."):
+                    ingest_status = queue.wait(ingest_job_id)
+                if ingest_status["state"] != DONE:
+                    st.error(f"Error processing XML files: {ingest_status['error']}")
+                    st.stop()
+                batch, trace = queue.result(ingest_job_id)
+            finally:
+                queue.remove(ingest_job_id)
+            record_trace(trace)
+            for name, result, error in batch:
+                if error is not None:
+                    ingest["errors"].append((name, error))
+                    continue
+                df, curves = result
+                ingest["file_data"][name] = df
+                ingest["curves"].update(curves)
+            st.session_state["page1_ingest"] = ingest
+            # Книга прошлого экспорта построена по другим файлам
+            st.session_state.pop("page1_export", None)
+        file_data = ingest["file_data"]
+        curves_dict = ingest["curves"]
+
+        for name, error in ingest["errors"]:
+            st.error(f"Error processing XML file {name}: {error}")
+
+        cache_stats = get_xml_cache().stats()
+        st.caption(
+            f"Parsed XML cache: {cache_stats['entries']} files, "
+            f"{cache_stats['bytes'] / 1024 / 1024:.1f} of {cache_stats['max_bytes'] / 1024 / 1024:.0f} MB, "
+            f"hits {cache_stats['hits']}, misses {cache_stats['misses']}"
+        )
 
         for df in file_data.values():
             compounds.update(df["Compound_name"].unique())
@@ -163,422 +676,106 @@ def Page1():
                    # Сохранение в словарь coefficients
                    coefficients[compound] = (a, b)
 
+
         st.subheader("Upload JSON Files for Each Compound")
         json_files = {}
+        # Разобранные JSON хранятся в сессии до замены файла
+        json_state = st.session_state.setdefault("page1_json", {})
         for compound in sorted(compounds):
             uploaded_json = st.file_uploader(f"Upload JSON for Compound: {compound}", type="json", key=compound)
             if uploaded_json:
-                try:
-                    json_files[compound] = load_json(uploaded_json)
-                except Exception as e:
-                    st.error(f"Error processing JSON for {compound}: {e}")
-
-        for compound in sorted(compounds):
-            # Инициализация сессии для округления
-            for col in ["response", "conc", "new_response", "new_conc"]:
-                if f"{col}_rounding_{compound}" not in st.session_state:
-                    st.session_state[f"{col}_rounding_{compound}"] = 2  # Значение по умолчанию
-                if f"{col}_digits_{compound}" not in st.session_state:
-                    st.session_state[f"{col}_digits_{compound}"] = 2  # Значение по умолчанию
-            
-            with st.sidebar:
-                 # Динамическое создание виджетов
-                 with st.expander(f"Настройка округления и разрядности для {compound}"):
-                      # Виджеты для округления
-                      response_rounding = st.number_input(
-                          f"Округление для Response ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"response_rounding_{compound}"],
-                          step=1, key=f"key_response_rounding_{compound}"
-                      )
-                      conc_rounding = st.number_input(
-                          f"Округление для Conc ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"conc_rounding_{compound}"],
-                          step=1, key=f"key_conc_rounding_{compound}"
-                      )
-                      new_response_rounding = st.number_input(
-                          f"Округление для newResponse ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"new_response_rounding_{compound}"],
-                          step=1, key=f"key_new_response_rounding_{compound}"
-                      )
-                      new_conc_rounding = st.number_input(
-                          f"Округление для newConc ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"new_conc_rounding_{compound}"],
-                          step=1, key=f"key_new_conc_rounding_{compound}"
-                      )
-
-                      # Виджеты для разрядности
-                      response_digits = st.number_input(
-                          f"Разрядность для Response ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"response_digits_{compound}"],
-                          step=1, key=f"key_response_digits_{compound}"
-                      )
-                      conc_digits = st.number_input(
-                          f"Разрядность для Conc ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"conc_digits_{compound}"],
-                          step=1, key=f"key_conc_digits_{compound}"
-                      )
-                      new_response_digits = st.number_input(
-                          f"Разрядность для newResponse ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"new_response_digits_{compound}"],
-                          step=1, key=f"key_new_response_digits_{compound}"
-                      )
-                      new_conc_digits = st.number_input(
-                          f"Разрядность для newConc ({compound})", min_value=0, max_value=10,
-                          value=st.session_state[f"new_conc_digits_{compound}"],
-                          step=1, key=f"key_new_conc_digits_{compound}"
-                      )
-
-                      # Обновляем значения в сессии
-                      st.session_state[f"response_rounding_{compound}"] = response_rounding
-                      st.session_state[f"conc_rounding_{compound}"] = conc_rounding
-                      st.session_state[f"new_response_rounding_{compound}"] = new_response_rounding
-                      st.session_state[f"new_conc_rounding_{compound}"] = new_conc_rounding
-
-                      st.session_state[f"response_digits_{compound}"] = response_digits
-                      st.session_state[f"conc_digits_{compound}"] = conc_digits
-                      st.session_state[f"new_response_digits_{compound}"] = new_response_digits
-                      st.session_state[f"new_conc_digits_{compound}"] = new_conc_digits
-
-
-        if st.button("Process and Export to Excel"):
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                for file_name, df in file_data.items():
-                    for compound, json_df in json_files.items():
-                        compound_df = df[df["Compound_name"] == compound].copy()
-
-                        if mode == "Use curves from XML":
-                            curve = curves_dict.get(compound, "")
-                        else:
-                            a, b = coefficients.get(compound, (0, 0))
-                            curve = f"{a}*x+{b}"
-
-                        json_df["Identifier"] = json_df.apply(
-                            lambda x: f"-{x['Subject']}-{x['Period']}-{str(int(x['timePoint']) - 1).zfill(2)}",
-                            axis=1
-                        )
-                        id_to_conc = dict(zip(json_df["Identifier"], json_df["CalcConc"]))
-
-                        compound_df["newConc"] = compound_df["Sample_name"].apply(
-                            lambda x: next((value for key, value in id_to_conc.items() if x.endswith(key)), "")
-                        )
-
-                        compound_df["newConc"] = compound_df["newConc"].apply(lambda x: "" if x == 0 else x)
-                        compound_df["newResponse"] = compound_df.apply(
-                            lambda row: calculate_result(row["newConc"], curve) if row["newConc"] else "",
-                            axis=1
-                        )
-
-                        df.loc[df["Compound_name"] == compound, "newConc"] = compound_df["newConc"]
-                        df.loc[df["Compound_name"] == compound, "newResponse"] = compound_df["newResponse"]
-                    
-                    # Применяем округление отдельно для каждой группы Compound_name
-                    for compound in df["Compound_name"].unique():
-
-                        # Получаем настройки округления и разрядности из сессии
-                        conc_rounding = st.session_state.get(f"conc_rounding_{compound}", 2)
-                        response_rounding = st.session_state.get(f"response_rounding_{compound}", 2)
-                        conc_digits = st.session_state.get(f"conc_digits_{compound}", 2)
-                        response_digits = st.session_state.get(f"response_digits_{compound}", 2)
-
-                        # Применяем округление к столбцам "Conc" и "Response"
-                        if "Conc" in df.columns:
-                            df.loc[df["Compound_name"] == compound, "Conc"] = apply_rounding(
-                                df.loc[df["Compound_name"] == compound, "Conc"], conc_rounding
-                            )
-                            df.loc[df["Compound_name"] == compound, "Conc"] = apply_digits(
-                                df.loc[df["Compound_name"] == compound, "Conc"], conc_digits
-                            )
-                        else:
-                            st.warning(f"Column 'Conc' not found for compound {compound}.")
-
-                        if "Response" in df.columns:
-                            df.loc[df["Compound_name"] == compound, "Response"] = apply_rounding(
-                                df.loc[df["Compound_name"] == compound, "Response"], response_rounding
-                            )
-                            df.loc[df["Compound_name"] == compound, "Response"] = apply_digits(
-                                df.loc[df["Compound_name"] == compound, "Response"], response_digits
-                            )
-                        else:
-                            st.warning(f"Column 'Response' not found for compound {compound}.")
-
-                        new_conc_rounding = st.session_state.get(f"new_conc_rounding_{compound}", 2)  # Значение по умолчанию
-                        new_response_rounding = st.session_state.get(f"new_response_rounding_{compound}", 2)
-                        new_conc_digits = st.session_state.get(f"new_conc_digits_{compound}", 2)
-                        new_response_digits = st.session_state.get(f"new_response_digits_{compound}", 2)
-
-                        if "newConc" in df.columns:
-                            df.loc[df["Compound_name"] == compound, "newConc"] = apply_rounding(
-                                df.loc[df["Compound_name"] == compound, "newConc"],
-                                new_conc_rounding
-                            )
-                            df.loc[df["Compound_name"] == compound, "newConc"] = apply_digits(
-                                                    df.loc[df["Compound_name"] == compound, "newConc"], new_conc_digits
-                                                )
-                        else:
-                            st.warning(f"Column 'newConc' not found for compound {compound}.")
-
-                        if "newResponse" in df.columns:
-                            df.loc[df["Compound_name"] == compound, "newResponse"] = apply_rounding(
-                                df.loc[df["Compound_name"] == compound, "newResponse"],
-                                new_response_rounding
-                            )
-                            df.loc[df["Compound_name"] == compound, "newResponse"] = apply_digits(
-                                df.loc[df["Compound_name"] == compound, "newResponse"], new_response_digits
-                            )
-                        else:
-                            st.warning(f"Column 'newResponse' not found for compound {compound}.")
-
-                        
-
-                    sheet_name = file_name.replace("/", "_").replace("\\", "_")[:31]
-
-                    # Добавляем новую пустую колонку newCreate_time
-                    df["newCreate_time"] = [""] * len(df)
-
-                    # Изменение порядка колонок
-                    desired_column_order = [
-                        "Compound_name", "Sample_name", "Create_time", "newCreate_time",
-                        "Response", "newResponse", "Conc", "newConc"
-                    ]
-                    existing_columns = [col for col in desired_column_order if col in df.columns]
-                    df = df[existing_columns]
-
-                    # Сохранение данных в Excel
-                    df.to_excel(writer, index=False, sheet_name=sheet_name)
-
-
-                    df.to_excel(writer, index=False, sheet_name=sheet_name)
-                    excel_sheets[sheet_name] = df  # Сохраняем данные для визуализации
-
-                    st.session_state["excel_sheets"] = excel_sheets
-
-                    worksheet = writer.sheets[sheet_name]
-                    for i, column in enumerate(df.columns):
-                        column_width = max(df[column].astype(str).map(len).max(), len(column)) + 2
-                        worksheet.set_column(i, i, column_width)
-
-            output.seek(0)
-            st.download_button(
-                label="Download Excel File",
-                data=output,
-                file_name="processed_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-
-        # Визуализация и редактирование таблиц по листам
-        if "excel_sheets" in st.session_state and st.session_state["excel_sheets"]:
-            st.subheader("View and Edit Excel Sheets")
-
-            # Выбор текущего листа
-            selected_sheet = st.selectbox("Select Sheet to View/Edit:", options=list(st.session_state["excel_sheets"].keys()))
-
-
-            # Получаем данные для текущего листа
-            df = st.session_state["excel_sheets"][selected_sheet]
-
-            # Настройка параметров AgGrid
-            gb = GridOptionsBuilder.from_dataframe(df)
-            gb.configure_default_column(editable=True)  # Делаем все колонки редактируемыми
-            gb.configure_grid_options(enableRangeSelection=True)
-            gb.configure_grid_options(enableFullScreen=True)  # Включаем полноэкранный режим
-            grid_options = gb.build()
-
-            # Отображаем таблицу с возможностью редактирования
-            grid_response = AgGrid(
-                df,
-                gridOptions=grid_options,
-                data_return_mode=DataReturnMode.FILTERED_AND_SORTED,
-                update_mode="MODEL_CHANGED",  # Автоматическое обновление данных при изменении
-                fit_columns_on_grid_load=True,
-                enable_enterprise_modules=False,
-                editable=True,
-            )
-
-            col1, col2 = st.columns(2)
-
-            with col1:
-                 #Обновление страницы путем ререндинга
-                 if st.button("Update the table"):
-                    st.query_params = {"rerun": "true"}
-
-            updated_df = pd.DataFrame(grid_response["data"])
-            
-            with col2:
-                #Очистка данных колонки newCreate_time
-                if st.button("Clear 'newCreate_time' column"):
-                   if "newCreate_time" in updated_df.columns:
-                       updated_df["newCreate_time"] = ""  # Очищаем колонку
-                       st.session_state["excel_sheets"][selected_sheet] = updated_df
-                       st.success("'newCreate_time' column has been cleared successfully!")
-                   else:
-                       st.warning("'newCreate_time' column does not exist in the selected sheet.")
-            
-            # Обновляем данные в сессии
-            st.session_state["excel_sheets"][selected_sheet] = updated_df
-            st.success(f"Changes to sheet '{selected_sheet}' saved successfully!")
-
-            updated_df = st.session_state["excel_sheets"][selected_sheet].reset_index(drop=True)
-
-            # Проверяем наличие колонок Create_time и newCreate_time
-            if "Create_time" in updated_df.columns and "newCreate_time" in updated_df.columns:
-                try:
-                    # Проверяем, что значение в первой строке newCreate_time корректное
-
-                    first_value = updated_df.loc[0, "newCreate_time"]
-
-                    # Проверяем, не пустое ли значение и строковый ли тип
-                    if isinstance(first_value, str) and len(first_value.split(":")) == 3:
-                        first_time = datetime.strptime(first_value, "%H:%M:%S")
-                        first_hour = first_time.hour
-                    else:
-                        st.warning("The first value of 'newCreate_time' is not in a valid time format (HH:MM:SS). Update skipped.")
-                        first_time = None
-
-                    # Выполняем обновление, только если значение корректное
-                    if first_time:
-                        for i in range(1, len(updated_df)):
-                            try:
-                                # Преобразуем значения Create_time в datetime
-                                prev_time = datetime.strptime(str(updated_df.loc[i - 1, "Create_time"]), "%H:%M:%S")
-                                curr_time = datetime.strptime(str(updated_df.loc[i, "Create_time"]), "%H:%M:%S")
-
-                                # Рассчитываем разницу времени
-                                time_difference = curr_time - prev_time 
-
-                                # Изменяем час в prev_time на hour из first_time
-                                prev_time = prev_time.replace(hour=first_hour)
-
-                                new_time = prev_time + time_difference
-                                new_time = new_time.time()
-                                
-                                # Записываем новое время в newCreate_time
-                                updated_df.loc[i, "newCreate_time"] = new_time.strftime("%H:%M:%S")
-
-                                
-                            except ValueError as row_error:
-                                st.warning(f"Row {i} has invalid time format in 'Create_time': {row_error}")
-                            except Exception as row_error:
-                                st.warning(f"Unexpected error processing row {i}: {row_error}")
-
-                        st.session_state["excel_sheets"][selected_sheet] = updated_df
-
-                except Exception as e:
-                    st.error(f"Error while processing newCreate_time: {e}")
-            else:
-                st.warning("Columns 'Create_time' and/or 'newCreate_time' are missing. No updates applied.")
-
-        
+                loaded = json_state.get(compound)
+                if loaded is None or loaded[0] != uploaded_json.file_id:
+                    try:
+                        loaded = (uploaded_json.file_id, load_json(uploaded_json), None)
+                    except Exception as e:
+                        loaded = (uploaded_json.file_id, None, e)
+                    json_state[compound] = loaded
+                if loaded[2] is not None:
+                    st.error(f"Error processing JSON for {compound}: {loaded[2]}")
+                else:
+                    json_files[compound] = loaded[1]
+
+        with st.sidebar:
+            for compound in sorted(compounds):
+                rounding_settings_stage(compound)
+
+        export_stage(file_data, curves_dict, json_files, coefficients, mode)
 
         # Инициализация сессии для хранения значений виджетов ввода
         if "page_inputs" not in st.session_state:
             st.session_state["page_inputs"] = {}
 
-        # Динамическое создание виджетов ввода для Page
-        if st.session_state["excel_sheets"]:
-            st.subheader("Generate New Excel File with Old and New Values")
-
-            # Создание словаря для хранения значений Page для каждого соединения
-            page_inputs = st.session_state["page_inputs"]
-
+        # Визуализация и редактирование таблиц по листам
+        if "excel_sheets" in st.session_state and st.session_state["excel_sheets"]:
+            # Поля номеров страниц строятся раньше редактора: он сверяется
+            # с набором соединений, по которому они построены
             with st.sidebar:
-                 # Динамическое создание виджетов
-                 with st.expander("Номера страниц"):
-                      for sheet_name, df in st.session_state["excel_sheets"].items():
-                          st.write(f"### Sheet: {sheet_name}")
-                          compounds = df["Compound_name"].unique()
-
-                          
-                          for compound in compounds:
-                              st.write(f"#### Compound: {compound}")
-                              
-                              
-                              # Уникальные ключи для виджетов
-                              key_newConc_newResponse  = f"newConc_newResponse _{sheet_name}_{compound}_value"
-                              key_newCreate_time = f"newCreate_time_{sheet_name}_{compound}_value"
-                              
-                              # Инициализация значений виджетов
-                              if key_newConc_newResponse not in st.session_state:
-                                  st.session_state[key_newConc_newResponse] = 1
-                              if key_newCreate_time not in st.session_state:
-                                  st.session_state[key_newCreate_time] = 0
-
-                              st.session_state[key_newConc_newResponse] = st.number_input(
-                                  f"Page for newConc and newResponse ({compound})", min_value=0, step=1, value=st.session_state[key_newConc_newResponse], key=f"key_{key_newConc_newResponse}"
-                              )
-                          
-                              st.session_state[key_newCreate_time] = st.number_input(
-                                  f"Page for newCreate_time ({compound})", min_value=0, step=1, value=st.session_state[key_newCreate_time], key=f"key_{key_newCreate_time}"
-                              )
-
-                              # Сохраняем значения в сессию
-                              page_inputs[(sheet_name, compound)] = {
-                                  "newConc_newResponse_page": st.session_state[key_newConc_newResponse],
-                                  "newCreate_time_page": st.session_state[key_newCreate_time],
-                              }
-
-            # Генерация нового файла Excel
-            if st.button("Generate New Excel with Old and New Values"):
-                new_output = BytesIO()
-                with pd.ExcelWriter(new_output, engine='xlsxwriter') as new_writer:
-                    
-                    workbook = new_writer.book  # Получаем доступ к книге Excel
-                    text_format = workbook.add_format({'num_format': '@'})  # Формат для текста
-
-                    for sheet_name, df in st.session_state["excel_sheets"].items():
-                        
-                            # Фильтруем строки, где newConc и newResponse не пусты
-                            filtered_df = df[
-                                (df["newConc"].notna()) & (df["newResponse"].notna())
-                            ]
-
-                            if not filtered_df.empty:
-                                # Создаём DataFrame для Old Value, New Value и Page
-                                result_df = pd.DataFrame({
-                                    "Old Value": list(filtered_df["Response"]) + list(filtered_df["Conc"]) + list(filtered_df["Create_time"]),
-                                    "New Value": list(filtered_df["newResponse"]) + list(filtered_df["newConc"]) + list(filtered_df["newCreate_time"]),
-                                    "Page": sum([
-                                        [
-                                            page_inputs[(sheet_name, row["Compound_name"])][f"{key}_page"]
-                                            for _, row in filtered_df.iterrows()
-                                        ]
-                                        for key in ["newConc_newResponse","newConc_newResponse", "newCreate_time"]
-                                    ], [])
-                                })
-
-                                # Удаляем строки, где New Value пустое
-                                result_df = result_df[
-                                    result_df["New Value"].notna()
-                                    & (result_df["New Value"] != "")
-                                    & (result_df["New Value"].astype(str).str.strip() != "")
-                                ]
-
-                                # Удаляем строки, где Old Value пустое
-                                result_df = result_df[
-                                    result_df["Old Value"].notna()
-                                    & (result_df["Old Value"] != "")
-                                    & (result_df["Old Value"].astype(str).str.strip() != "")
-                                ]
-
-                                # Формируем название листа
-                                clean_sheet_name = f"{sheet_name.replace('.xml', '').replace('.', '_')}"[:31]  # Ограничение по длине имени листа
-
-                                # Записываем результат на новый лист
-                                result_df.to_excel(new_writer, index=False, sheet_name=clean_sheet_name)
-
-                                worksheet = new_writer.sheets[clean_sheet_name]  # Получаем доступ к текущему листу
-                    
-                                # Применяем текстовый формат ко всем ячейкам
-                                for col_num, _ in enumerate(result_df.columns):
-                                    worksheet.set_column(col_num, col_num, None, text_format)
-
-                new_output.seek(0)
-                st.download_button(
-                    label="Download Filtered Excel File",
-                    data=new_output,
-                    file_name="filtered_data.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
-                st.success("New Excel file generated successfully!")
+                page_inputs_section()
 
-    
\ No newline at end of file
+            sheet_editor_stage()
+
+            st.subheader("Generate New Excel File with Old and New Values")
+            value_tables_stage()
+
+    # Словари сессии регистрируются в конце прохода, когда этапы их уже заменили
+    touch_session(session_stores())
+
+    with st.expander("Session memory"):
+        # Сколько памяти держит эта сессия; листы хранятся в компактном виде
+        memory_rows = [
+            {"Data": f"Sheet {name}", "Rows": len(df), "MB": frame_memory_bytes(df) / 1024 / 1024}
+            for name, df in st.session_state["excel_sheets"].items()
+        ]
+        ingest = st.session_state.get("page1_ingest") or {}
+        memory_rows.append({
+            "Data": "Parsed XML",
+            "Rows": sum(len(df) for df in ingest.get("file_data", {}).values()),
+            "MB": sum(map(frame_memory_bytes, ingest.get("file_data", {}).values())) / 1024 / 1024,
+        })
+        json_frames = [
+            loaded[1] for loaded in st.session_state.get("page1_json", {}).values()
+            if loaded[1] is not None
+        ]
+        memory_rows.append({
+            "Data": "JSON",
+            "Rows": sum(map(len, json_frames)),
+            "MB": sum(map(frame_memory_bytes, json_frames)) / 1024 / 1024,
+        })
+        export = st.session_state.get("page1_export") or {}
+        memory_rows.append({
+            "Data": "Exported workbook", "Rows": None,
+            # Книга больше EDIT_PDF_EXPORT_SPILL_MB хранится на диске
+            "MB": 0 if export.get("on_disk", True) else export["stats"]["output_bytes"] / 1024 / 1024,
+        })
+        mapping_tables = st.session_state.get("mapping_tables") or {}
+        memory_rows.append({
+            "Data": "Tables for the PDF editing page", "Rows": None,
+            "MB": sum(map(len, mapping_tables.values())) / 1024 / 1024,
+        })
+        memory_report = pd.DataFrame(memory_rows)
+        st.dataframe(memory_report.round({"MB": 2}), hide_index=True)
+        st.caption(
+            f"Total {memory_report['MB'].sum():.1f} MB. "
+            f"Active sessions: {len(get_session_registry())}; data of sessions idle for more than "
+            f"{get_session_registry().idle_seconds // 60} min is released."
+        )
+
+    traces = st.session_state.get("page1_traces") or {}
+    if traces:
+        with st.expander("Diagnostics"):
+            # Замеры последней загрузки XML и последнего экспорта
+            for trace in traces.values():
+                render_trace(st, trace, {
+                    "unit": "s", "name": "Stage", "calls": "Calls", "seconds": "Seconds",
+                    "share": "Share of run", "counter": "Counter", "value": "Value",
+                })
+            st.caption(
+                "Set EDIT_PDF_TRACE_LOG to append these measurements to a JSON Lines file."
+            )
+            st.download_button(
+                label="Download measurements (JSON Lines)",
+                data="".join(trace.to_json_lines() for trace in traces.values()),
+                file_name="page1_trace.jsonl",
+                mime="application/x-ndjson",
+            )
@@ -1,105 +1,395 @@
 def Page2():
 
     import streamlit as st
-    import fitz  # PyMuPDF
     import pandas as pd
-    from io import BytesIO
+    import os
+    import tempfile
+    import zipfile
+    from contextlib import closing
+    from cache import ByteLRUCache, content_hash
+    from diagnostics import Trace, activate, profiled, render_trace, span, write_json_lines
+    from jobs import ACTIVE_STATES, CANCELLED, FAILED, QUEUED, JobRecord
+    from redaction import (
+        DEFAULT_SAVE_PROFILE, SAVE_PROFILES, build_redaction_plan, iter_process_batch,
+        load_mapping_sheets, pdf_sheet_name, read_mapping_parquet,
+    )
+    from resources import get_job_queue, session_stores, touch_session
 
-    def redact_text_on_page(page, df, page_number):
+    @st.cache_resource
+    def get_result_cache():
         """
-        Заменяет текст на указанной странице документа.
+        Общий для всех сессий кэш обработанных PDF.
 
-        :param page: Объект страницы документа
-        :param df: DataFrame с данными для замены
-        :param page_number: Номер страницы для обработки
+        Объём в памяти задаётся переменной окружения EDIT_PDF_CACHE_MB,
+        каталог дискового уровня — EDIT_PDF_CACHE_DIR.
         """
-        df['Page'] = df['Page'].astype(str)
-
-        # Фильтруем данные для текущей страницы
-        df_page = df[df['Page'] == str(page_number)]
-
-        for raw_text in df_page['Old Value'].unique():
-            # Фильтруем строки с текущим старым значением
-            df_matches = df_page[df_page['Old Value'] == raw_text]
-            new_values = df_matches['New Value'].values
-
-            # Поиск всех совпадений старого текста на странице
-            hits = page.search_for(raw_text)
-
-            # Обрабатываем каждое совпадение
-            for rect, new_text in zip(hits, new_values):
-                # Параметры для редактирования
-                new_width = -0.1    # Новая ширина прямоугольника
-                new_width_2 = -14   # Новая ширина прямоугольника
-                new_height = -1.1   # Новая высота прямоугольника
-                new_height_2 = -0.85   # Новая высота прямоугольника
-
-                # Вычисление новых координат
-                x1, y1, x2, y2 = rect
-                new_x1 = x1 + new_width_2
-                new_x2 = x2 + new_width
-                new_y2 = y2 - new_height_2 * 1.1
-                new_y1 = y1 + new_height
-                new_rect = fitz.Rect(new_x1, new_y1, new_x2, new_y2)
-
-                # Удаляем старый текст через аннотацию
-                page.add_redact_annot(rect)  # Добавляем аннотацию редактирования
-                page.apply_redactions()     # Применяем редактирование
-
-                # Вставка нового текста
-                page.insert_textbox(
-                    new_rect,
-                    new_text,
-                    fontsize=7.86,            # Размер шрифта
-                    fontname=page.get_fonts()[1][4],         # Имя шрифта (уточните имя шрифта)
-                    align=fitz.TEXT_ALIGN_RIGHT,  # Выравнивание текста
-                    color=(0, 0, 0)           # Цвет текста (черный)
-                )
-
-    def process_pdf(pdf_file, excel_data, sheet_name):
-        """Обрабатывает PDF файл, редактируя текст на основе данных Excel."""
-        pdf_bytes = BytesIO(pdf_file.read())
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        return ByteLRUCache(
+            max_bytes=int(os.environ.get("EDIT_PDF_CACHE_MB", 512)) * 1024 * 1024,
+            disk_dir=os.environ.get("EDIT_PDF_CACHE_DIR") or None,
+            disk_max_bytes=int(os.environ.get("EDIT_PDF_CACHE_DISK_MB", 4096)) * 1024 * 1024,
+        )
 
-        sheet_data = excel_data[sheet_name]
-        for page_number in range(len(doc)):
-            redact_text_on_page(doc[page_number], sheet_data, page_number)
-
-        output = BytesIO()
-        doc.save(output, garbage=4, deflate=True)
-        doc.close()
-        return output
+    @st.cache_resource
+    def get_sheet_cache():
+        """
+        Общий для всех сессий кэш разобранных листов Excel.
 
-    # Streamlit UI
-    st.title("PDF и Excel обработчик для редактирования")
+        Объём задаётся переменной окружения EDIT_PDF_SHEET_CACHE_MB.
+        """
+        return ByteLRUCache(
+            max_bytes=int(os.environ.get("EDIT_PDF_SHEET_CACHE_MB", 128)) * 1024 * 1024
+        )
 
-    uploaded_pdfs = st.file_uploader("Загрузите PDF файлы", type="pdf", accept_multiple_files=True)
-    uploaded_excel = st.file_uploader("Загрузите Excel файл", type="xlsx")
+    def submit_redaction_job(queue, job_key, uploaded_pdfs, sheet_names, mapping_tables,
+                             uploaded_excel, workers, shard_size, save_profile, bundle_spill,
+                             profile):
+        """
+        Сопоставляет PDF с листами замен и ставит их обработку в очередь.
 
-    if uploaded_pdfs and uploaded_excel:
-        # Чтение Excel файла
-        excel_data = pd.read_excel(uploaded_excel, sheet_name=None, dtype=str)
+        :param mapping_tables: Таблицы замен из сессии или None, если листы
+            читаются из uploaded_excel
+        :param bundle_spill: Порог в байтах для PDF, которые до записи в архив
+            хранятся на диске, или None, если архив не нужен
+        :param profile: Профилировать задание через cProfile
+        :return: Словарь задания для сессии: key, id, messages, names
+        """
+        if mapping_tables is not None:
+            excel_data = {
+                name: read_mapping_parquet(mapping_tables[name])
+                for name in dict.fromkeys(sheet_names) if name in mapping_tables
+            }
+        else:
+            # Чтение только тех листов Excel, которые соответствуют загруженным PDF
+            excel_data = load_mapping_sheets(
+                uploaded_excel.getvalue(), sheet_names, cache=get_sheet_cache(),
+            )
 
-        processed_files = []
+        jobs = []
+        job_names = []
+        messages = []
         for pdf_file in uploaded_pdfs:
             # Убираем расширение у имени PDF файла
-            pdf_name = pdf_file.name.rsplit('.', 1)[0]
-            
+            pdf_name = pdf_sheet_name(pdf_file.name)
 
             # Проверяем совпадение между именем PDF и листами Excel
             if pdf_name in excel_data:
-                processed_pdf = process_pdf(pdf_file, excel_data, pdf_name)
-                processed_files.append((pdf_file.name, processed_pdf))
+                jobs.append((pdf_file.getvalue(), build_redaction_plan(excel_data[pdf_name])))
+                job_names.append((pdf_file.name, pdf_name))
             else:
-                st.warning(f"Лист Excel для файла {pdf_file.name} не найден.")
+                messages.append(f"Лист Excel для файла {pdf_file.name} не найден.")
+
+        # Кэш берётся в основном потоке: задание выполняется вне сессии Streamlit
+        result_cache = get_result_cache()
+        trace_log = os.environ.get("EDIT_PDF_TRACE_LOG")
+
+        def redaction_job(progress):
+            # Процессы берутся из общего бюджета очереди: задания всех сессий
+            # вместе не запускают больше процессов, чем в нём есть
+            with progress.reserve_processes(workers) as processes:
+                trace = Trace(
+                    "page2.redaction", files=len(jobs), workers=processes,
+                    save_profile=save_profile,
+                )
+                with activate(trace), profiled(trace, profile):
+                    result = process_jobs(progress, processes)
+            write_json_lines(trace.finish(), trace_log)
+            result["trace"] = trace
+            return result
+
+        def process_jobs(progress, processes):
+            # Ход считается по страницам плана: в одном процессе — после каждой
+            # страницы, в пуле процессов и для результатов из кэша — по файлам
+            pages_reported = [0]
+
+            def on_page():
+                progress.advance(1)
+                pages_reported[0] += 1
+
+            reports = [None] * len(jobs)
+
+            def record(index, missing_pages, stats):
+                progress.advance(
+                    max(len(jobs[index][1]) - pages_reported[0], 0),
+                    f"Обработан {job_names[index][0]}",
+                )
+                pages_reported[0] = 0
+                reports[index] = (missing_pages, stats)
+
+            results = iter_process_batch(
+                jobs, workers=processes, shard_size=shard_size, cache=result_cache,
+                spill_threshold=bundle_spill if bundle_spill and jobs else None,
+                save_profile=save_profile, on_page=on_page, spill_dir=queue.work_dir,
+            )
+            with closing(results):
+                if not (bundle_spill and jobs):
+                    files = [None] * len(jobs)
+                    for index, (processed_pdf, missing_pages, stats) in results:
+                        files[index] = processed_pdf
+                        record(index, missing_pages, stats)
+                    return {"files": files, "archive": None, "reports": reports}
+
+                # Каждый готовый PDF сразу пишется в архив на диске, крупные PDF
+                # тоже уходят на диск; в очереди хранится только путь к архиву.
+                # Файлы лежат в каталоге очереди, который очищается при её создании
+                fd, archive_path = tempfile.mkstemp(prefix="edit_pdf_", suffix=".zip", dir=queue.work_dir)
+                os.close(fd)
+                spilled = set()
+                try:
+                    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED) as zf:
+                        for index, (processed_pdf, missing_pages, stats) in results:
+                            arcname = f"updated_{job_names[index][0]}"
+                            with span("zip_write"):
+                                if isinstance(processed_pdf, str):
+                                    spilled.add(processed_pdf)
+                                    zf.write(processed_pdf, arcname)
+                                else:
+                                    zf.writestr(arcname, processed_pdf)
+                            record(index, missing_pages, stats)
+                except BaseException:
+                    os.remove(archive_path)
+                    raise
+                finally:
+                    for path in spilled:
+                        os.remove(path)
+                return {"files": None, "archive": archive_path, "reports": reports}
+
+        def remove_archive(result):
+            if result["archive"] is not None and os.path.exists(result["archive"]):
+                os.remove(result["archive"])
+
+        job_id = queue.submit(
+            redaction_job, total=sum(len(plan) for _, plan in jobs), label="Обработка PDF",
+            cleanup=remove_archive,
+        )
+        # Запись удаляет задание с результатом, когда сессия освобождается при простое
+        return JobRecord(queue, key=job_key, id=job_id, messages=messages, names=job_names)
+
+    def redaction_stage(page2_job, job_active):
+        """
+        Ход задания обработки и его результаты.
+
+        Пока задание активно, фрагмент опрашивает очередь раз в секунду; после
+        завершения страница перезапускается один раз, чтобы опрос прекратился.
+        Результат хранится в очереди, пока не истечёт срок хранения.
+        """
 
-        if processed_files:
-            for name, processed_pdf in processed_files:
+        @st.fragment(run_every=1 if job_active else None)
+        def show():
+            touch_session()
+            queue = get_job_queue()
+            status = queue.status(page2_job["id"])
+            if status is None:
+                # Срок хранения истёк — задание будет поставлено заново
+                st.rerun()
+
+            for message in page2_job["messages"]:
+                st.warning(message)
+
+            if status["state"] in ACTIVE_STATES:
+                if status["state"] == QUEUED:
+                    text = f"Обработка в очереди, позиция {status['position']}"
+                else:
+                    eta = status["eta_seconds"]
+                    text = (
+                        f"{status['message'] or 'Обработка'} — страниц {status['done']} из {status['total']}"
+                        + (f", осталось около {eta:.0f} с" if eta is not None else "")
+                    )
+                st.progress(
+                    min(status["done"] / status["total"], 1.0) if status["total"] else 0.0, text=text
+                )
+                if st.button("Отменить обработку"):
+                    queue.cancel(page2_job["id"])
+                return
+            if job_active:
+                st.rerun()
+
+            if status["state"] in (FAILED, CANCELLED):
+                if status["state"] == FAILED:
+                    st.error(f"Ошибка обработки: {status['error']}")
+                else:
+                    st.info("Обработка отменена.")
+                if st.button("Запустить заново"):
+                    queue.remove(page2_job["id"])
+                    del st.session_state["page2_job"]
+                    st.rerun()
+                return
+
+            result = queue.result(page2_job["id"])
+            job_names = page2_job["names"]
+            run_stats = []
+            for index, (missing_pages, stats) in enumerate(result["reports"]):
+                name, pdf_name = job_names[index]
+                if missing_pages:
+                    st.warning(
+                        f"В листе {pdf_name} указаны страницы, которых нет в {name}: "
+                        f"{', '.join(missing_pages)}"
+                    )
+                run_stats.append({
+                    "Файл": name,
+                    "Страниц": stats["pages_touched"],
+                    "Замен": stats["hits"],
+                    "Не найдено": stats["misses"],
+                    "Профиль": stats["save_profile"],
+                    "Обработка, с": round(stats["total_seconds"], 3),
+                    "Сохранение, с": round(stats["save_seconds"], 3),
+                    "Размер, КБ": round(stats["output_bytes"] / 1024, 1),
+                    "Из кэша": "да" if stats["cached"] else "нет",
+                })
+
+            if result["archive"] is not None:
+                # Архив хранится на диске, пока задание в очереди. Кнопка скачивания
+                # Streamlit держит копию данных в памяти, пока она на странице,
+                # поэтому архив читается только по запросу и на одно скачивание
+                archive_mb = os.path.getsize(result["archive"]) / 1024 / 1024
+
+                def prepare_archive():
+                    st.session_state["page2_archive_job"] = page2_job["id"]
+
+                def release_archive():
+                    st.session_state.pop("page2_archive_job", None)
+
+                if st.session_state.get("page2_archive_job") == page2_job["id"]:
+                    with open(result["archive"], "rb") as archive:
+                        st.download_button(
+                            label=f"Скачать все обработанные PDF ({len(job_names)}) одним архивом",
+                            data=archive,
+                            file_name="updated_pdfs.zip",
+                            mime="application/zip",
+                            on_click=release_archive,
+                        )
+                else:
+                    st.button(
+                        f"Подготовить архив ({archive_mb:.1f} МБ) к скачиванию",
+                        on_click=prepare_archive,
+                    )
+                    st.caption("Архив хранится на диске и загружается в память сервера только для скачивания.")
+            elif result["files"]:
+                for (name, _), processed_pdf in zip(job_names, result["files"]):
+                    st.download_button(
+                        label=f"Скачать обработанный {name}",
+                        data=processed_pdf,
+                        file_name=f"updated_{name}",
+                        mime="application/pdf",
+                    )
+            else:
+                st.warning("Не найдено совпадений между файлами PDF и листами Excel.")
+                return
+
+            with st.expander("Время и размер результата"):
+                st.dataframe(pd.DataFrame(run_stats), hide_index=True)
+
+            trace = result["trace"]
+            with st.expander("Диагностика"):
+                render_trace(st, trace, {
+                    "unit": "с", "name": "Этап", "calls": "Вызовов", "seconds": "Секунд",
+                    "share": "Доля прогона", "counter": "Счётчик", "value": "Значение",
+                })
+                st.caption(
+                    "Этапы процессов пула суммируются по процессам, поэтому доля может "
+                    "быть больше 1. Чтобы дописывать замеры в файл JSON Lines, задайте "
+                    "EDIT_PDF_TRACE_LOG."
+                )
                 st.download_button(
-                    label=f"Скачать обработанный {name}",
-                    data=processed_pdf.getvalue(),
-                    file_name=f"updated_{name}",
-                    mime="application/pdf",
+                    label="Скачать замеры (JSON Lines)",
+                    data=trace.to_json_lines(),
+                    file_name="page2_trace.jsonl",
+                    mime="application/x-ndjson",
                 )
+
+        show()
+
+    # Streamlit UI
+    st.title("PDF и Excel обработчик для редактирования")
+
+    if touch_session():
+        st.info(
+            "Данные этой сессии были освобождены после простоя. "
+            "Загрузите файлы снова, чтобы продолжить."
+        )
+
+    uploaded_pdfs = st.file_uploader("Загрузите PDF файлы", type="pdf", accept_multiple_files=True)
+
+    # Таблицы замен, подготовленные на странице «Получение исходных данных»
+    mapping_tables = st.session_state.get("mapping_tables")
+    use_mapping_tables = False
+    if mapping_tables:
+        use_mapping_tables = st.radio(
+            "Источник таблиц замен",
+            [True, False],
+            format_func=lambda value: (
+                f"Таблицы со страницы «Получение исходных данных» ({len(mapping_tables)})"
+                if value else "Файл Excel"
+            ),
+        )
+    uploaded_excel = None
+    if not use_mapping_tables:
+        uploaded_excel = st.file_uploader("Загрузите Excel файл", type="xlsx")
+
+    with st.expander("Параметры обработки"):
+        workers = st.number_input(
+            "Количество параллельных процессов", min_value=1, max_value=os.cpu_count() or 1,
+            value=1, step=1,
+            help="Процессы общие для всех пользователей сервера: если свободных меньше, "
+                 "обработка запускается с теми, что есть, или в одном процессе.",
+        )
+        shard_pages = st.checkbox(
+            "Делить большие PDF по страницам между процессами", disabled=workers == 1,
+            help="PDF с оглавлением, ссылками или формами всегда обрабатываются целиком.",
+        )
+        shard_size = st.number_input(
+            "Страниц в одной части", min_value=1, value=10, step=1, disabled=not shard_pages
+        )
+        save_profile = st.selectbox(
+            "Профиль сохранения PDF", list(SAVE_PROFILES),
+            index=list(SAVE_PROFILES).index(DEFAULT_SAVE_PROFILE),
+            format_func=lambda name: {
+                "fast": "fast — быстрое сохранение для черновиков",
+                "balanced": "balanced — полная сборка мусора и сжатие потоков",
+                "smallest": "smallest — минимальный размер файла",
+            }[name],
+        )
+        bundle = st.checkbox("Скачать все файлы одним ZIP-архивом")
+        spill_mb = st.number_input(
+            "Хранить на диске обработанные PDF больше, МБ", min_value=1, value=50, step=1,
+            disabled=not bundle
+        )
+        profile_run = st.checkbox(
+            "Профилировать обработку через cProfile",
+            help="Обработка запускается заново с профилированием; отчёт — в разделе «Диагностика».",
+        )
+
+    if uploaded_pdfs and (uploaded_excel or use_mapping_tables):
+        queue = get_job_queue()
+        sheet_names = [pdf_sheet_name(pdf_file.name) for pdf_file in uploaded_pdfs]
+
+        # Обработка запускается заново только при смене файлов, таблиц замен или
+        # параметров; перезапуски страницы лишь опрашивают уже поставленное задание
+        if use_mapping_tables:
+            source_key = tuple(
+                (name, content_hash(mapping_tables[name]))
+                for name in dict.fromkeys(sheet_names) if name in mapping_tables
+            )
         else:
-            st.warning("Не найдено совпадений между файлами PDF и листами Excel.")
+            source_key = uploaded_excel.file_id
+        job_key = (
+            tuple(pdf_file.file_id for pdf_file in uploaded_pdfs), source_key,
+            workers, shard_size if shard_pages else None, save_profile, bundle, spill_mb,
+            profile_run,
+        )
+        page2_job = st.session_state.get("page2_job")
+        # Пустая запись остаётся от сессии, данные которой освобождены при простое
+        if not page2_job or page2_job["key"] != job_key or queue.status(page2_job["id"]) is None:
+            if page2_job:
+                page2_job.clear()
+            page2_job = submit_redaction_job(
+                queue, job_key, uploaded_pdfs, sheet_names, mapping_tables if use_mapping_tables else None,
+                uploaded_excel, workers, shard_size if shard_pages else None, save_profile,
+                spill_mb * 1024 * 1024 if bundle else None, profile_run,
+            )
+            st.session_state["page2_job"] = page2_job
+
+        job_status = queue.status(page2_job["id"])
+        redaction_stage(page2_job, job_status["state"] in ACTIVE_STATES)
+
+    # Данные сессии освобождаются, если она простаивает на любой из страниц
+    touch_session(session_stores())
@@ -0,0 +1,223 @@
+"""
+Кэш результатов с ограничением по объёму памяти и вытеснением LRU
+и учёт данных, которые сессии держат в памяти.
+
+Один экземпляр кэша (и реестра сессий) разделяется всеми сессиями
+Streamlit, поэтому доступ к нему защищён блокировкой.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_hash(data):
+    """Возвращает SHA-256 от байтов в виде hex-строки."""
+    return hashlib.sha256(data).hexdigest()
+
+
+# Заголовок файла дискового уровня: длина JSON с остальными полями значения
+DISK_HEADER = struct.Struct(">I")
+
+
+class ByteLRUCache:
+    """
+    LRU-кэш с бюджетом в байтах и необязательным уровнем на диске.
+
+    Значения, вытесненные из памяти, остаются на диске (если задан
+    disk_dir) и поднимаются обратно в память при следующем обращении.
+    На диск попадают только значения вида bytes или кортеж (bytes, ...),
+    остальные поля которого сериализуются в JSON; файл хранит заголовок
+    с этими полями и сами байты, поэтому чтение не исполняет код.
+
+    :param max_bytes: Максимальный суммарный размер значений в памяти
+    :param disk_dir: Каталог для дискового уровня; None — только память
+    :param disk_max_bytes: Максимальный суммарный размер файлов на диске
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ключ -> (значение, размер)
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, mode=0o700, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу и отмечает его как недавно использованное."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+            value, size = self._read_disk(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._store(key, value, size)
+            return value
+
+    def put(self, key, value, size):
+        """
+        Сохраняет значение в кэше.
+
+        :param size: Размер значения в байтах, по нему считается бюджет памяти
+        """
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._store(key, value, size)
+            self._write_disk(key, value)
+
+    def clear(self):
+        """Очищает уровень в памяти и сбрасывает счётчики."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Возвращает счётчики кэша для отображения в интерфейсе."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _store(self, key, value, size):
+        # Значение больше всего бюджета в памяти не держим
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def _disk_path(self, key):
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, hashlib.sha256(repr(key).encode()).hexdigest() + ".bin")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        if path is None or not os.path.exists(path):
+            return None, 0
+        try:
+            with open(path, "rb") as f:
+                (header_size,) = DISK_HEADER.unpack(f.read(DISK_HEADER.size))
+                rest = json.loads(f.read(header_size))["rest"]
+                payload = f.read()
+        except (OSError, struct.error, ValueError, KeyError, TypeError):
+            return None, 0
+        # Обновляем время изменения, чтобы файл считался недавно использованным
+        os.utime(path)
+        value = payload if rest is None else (payload, *rest)
+        return value, len(payload)
+
+    def _write_disk(self, key, value):
+        path = self._disk_path(key)
+        if path is None:
+            return
+        if isinstance(value, bytes):
+            payload, rest = value, None
+        elif isinstance(value, tuple) and value and isinstance(value[0], bytes):
+            payload, rest = value[0], list(value[1:])
+        else:
+            return
+        try:
+            header = json.dumps({"rest": rest}).encode()
+        except (TypeError, ValueError):
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(DISK_HEADER.pack(len(header)))
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+        if self.disk_max_bytes:
+            files = [
+                os.path.join(self.disk_dir, name)
+                for name in os.listdir(self.disk_dir) if name.endswith(".bin")
+            ]
+            files.sort(key=os.path.getmtime)
+            total = sum(os.path.getsize(name) for name in files)
+            for name in files:
+                if total <= self.disk_max_bytes:
+                    break
+                total -= os.path.getsize(name)
+                os.remove(name)
+
+
+class SessionRegistry:
+    """
+    Реестр сессий с освобождением данных простаивающих сессий.
+
+    Сессия при каждом выполнении страницы отмечается вместе со своими
+    хранилищами — словарями из st.session_state. Если сессия не выполнялась
+    дольше idle_seconds, её хранилища очищаются на месте, а запись удаляется;
+    так освобождается и память вкладок, которые уже закрыты.
+
+    :param idle_seconds: Время простоя, после которого данные сессии освобождаются
+    :param max_evicted: Сколько последних освобождённых сессий помнить, чтобы
+        сообщить о них при возвращении пользователя
+    """
+
+    def __init__(self, idle_seconds, max_evicted=1000):
+        self.idle_seconds = idle_seconds
+        self.max_evicted = max_evicted
+        self._sessions = {}  # id сессии -> (время последнего выполнения, хранилища)
+        self._evicted = OrderedDict()  # id освобождённой сессии -> None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def touch(self, session_id, stores=None, now=None):
+        """
+        Отмечает выполнение сессии и освобождает данные простаивающих сессий.
+
+        :param stores: Словари сессии, которые очищаются при простое;
+            None — оставить зарегистрированные ранее
+        :return: True, если данные этой сессии были освобождены с прошлого раза
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._evict_idle(now)
+            if stores is None:
+                stores = self._sessions.get(session_id, (now, []))[1]
+            self._sessions[session_id] = (now, [store for store in stores if store is not None])
+            evicted = session_id in self._evicted
+            self._evicted.pop(session_id, None)
+            return evicted
+
+    def _evict_idle(self, now):
+        idle = [
+            session_id for session_id, (last_seen, _) in self._sessions.items()
+            if now - last_seen > self.idle_seconds
+        ]
+        for session_id in idle:
+            _, stores = self._sessions.pop(session_id)
+            for store in stores:
+                store.clear()
+            self._evicted[session_id] = None
+            if len(self._evicted) > self.max_evicted:
+                self._evicted.popitem(last=False)
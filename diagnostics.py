@@ -0,0 +1,224 @@
+"""
+Замеры времени этапов обработки и счётчики для диагностики медленных прогонов.
+
+Trace собирает именованные интервалы (span) и счётчики одного прогона.
+Функции движков пишут в трассу, активную в текущем потоке (см. activate);
+если активной трассы нет, span и count ничего не делают. Процессы пула
+собирают собственную трассу (см. run_traced), а основной процесс добавляет
+её к своей через Trace.merge.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+_local = threading.local()
+
+
+class Trace:
+    """
+    Интервалы и счётчики одного прогона.
+
+    :param name: Название прогона, например "page1.export"
+    :param fields: Параметры прогона, которые попадают в каждую запись JSON
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.seconds = None  # Общее время, известно после finish
+        self.spans = {}  # имя -> [количество вызовов, секунды]
+        self.counters = {}
+        self.profile = None  # Отчёт cProfile, если прогон профилировался
+
+    def add_span(self, name, seconds, calls=1):
+        entry = self.spans.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, data):
+        """Добавляет интервалы и счётчики из Trace.as_dict (например, из процесса пула)."""
+        for name, (calls, seconds) in data["spans"].items():
+            self.add_span(name, seconds, calls)
+        for name, value in data["counters"].items():
+            self.count(name, value)
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+        return self
+
+    def as_dict(self):
+        return {
+            "spans": {name: list(entry) for name, entry in self.spans.items()},
+            "counters": dict(self.counters),
+        }
+
+    def span_rows(self):
+        """
+        Интервалы по убыванию времени: name, calls, seconds и share — доля
+        от общего времени прогона (None, пока прогон не завершён).
+        """
+        return [
+            {
+                "name": name, "calls": calls, "seconds": seconds,
+                "share": seconds / self.seconds if self.seconds else None,
+            }
+            for name, (calls, seconds) in sorted(
+                self.spans.items(), key=lambda item: item[1][1], reverse=True
+            )
+        ]
+
+    def records(self):
+        """
+        Записи для журнала: по одной на интервал и на счётчик и итоговая запись.
+        """
+        base = {"trace": self.name, "run_id": self.run_id, "started": self.started, **self.fields}
+        records = [
+            {**base, "kind": "span", "name": name, "calls": calls, "seconds": round(seconds, 6)}
+            for name, (calls, seconds) in self.spans.items()
+        ]
+        records.extend(
+            {**base, "kind": "counter", "name": name, "value": value}
+            for name, value in self.counters.items()
+        )
+        records.append({
+            **base, "kind": "total",
+            "seconds": round(self.seconds, 6) if self.seconds is not None else None,
+        })
+        return records
+
+    def to_json_lines(self):
+        return "".join(
+            json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in self.records()
+        )
+
+
+def current_trace():
+    """Трасса, активная в текущем потоке, или None."""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def activate(trace):
+    """Делает trace активной в текущем потоке на время блока."""
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def span(name):
+    """Замеряет время блока и добавляет его к интервалу name активной трассы."""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, time.perf_counter() - start)
+
+
+def add_span(name, seconds):
+    """Добавляет уже замеренное время к интервалу name активной трассы."""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(name, seconds)
+
+
+def count(name, value=1):
+    """Увеличивает счётчик name активной трассы."""
+    trace = current_trace()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def run_traced(func, *args):
+    """
+    Вызывает func со своей трассой; верхний уровень нужен для пула процессов.
+
+    :return: Результат func и Trace.as_dict для Trace.merge в основном процессе
+    """
+    with activate(Trace(func.__name__)) as trace:
+        result = func(*args)
+    return result, trace.as_dict()
+
+
+@contextmanager
+def profiled(trace, enabled=True, limit=40):
+    """
+    Профилирует блок через cProfile и сохраняет отчёт в trace.profile.
+
+    Профилируется только текущий поток; работа процессов пула в отчёт
+    не попадает.
+
+    :param limit: Сколько функций с наибольшим суммарным временем войдёт в отчёт
+    """
+    if not enabled:
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as e:
+        # С Python 3.12 одновременно может работать только один профилировщик
+        trace.profile = f"cProfile is not available: {e}"
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(limit)
+        trace.profile = report.getvalue()
+
+
+def render_trace(st, trace, labels):
+    """
+    Выводит замеры трассы: общее время, таблицу этапов, счётчики и отчёт профилировщика.
+
+    Модуль не зависит от Streamlit, поэтому страница передаёт его сама.
+
+    :param st: Модуль streamlit или контейнер (например, st.expander)
+    :param labels: Подписи на языке страницы: "unit" — единица секунд в заголовке,
+        "name", "calls", "seconds", "share" — столбцы этапов,
+        "counter", "value" — столбцы счётчиков
+    """
+    st.markdown(f"**{trace.name}** — {trace.seconds:.2f} {labels['unit']}")
+    columns = ["name", "calls", "seconds", "share"]
+    stages = pd.DataFrame(trace.span_rows(), columns=columns)
+    stages.columns = [labels[column] for column in columns]
+    st.dataframe(stages.round({labels["seconds"]: 3, labels["share"]: 3}), hide_index=True)
+    if trace.counters:
+        st.dataframe(
+            pd.DataFrame(list(trace.counters.items()), columns=[labels["counter"], labels["value"]]),
+            hide_index=True,
+        )
+    if trace.profile:
+        st.code(trace.profile, language=None)
+
+
+def write_json_lines(trace, path):
+    """Дописывает записи трассы в файл JSON Lines; path=None — ничего не делает."""
+    if not path:
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(trace.to_json_lines())
@@ -0,0 +1,742 @@
+"""
+Обработка XML-экспортов прибора и JSON для страницы «XML & JSON Integration».
+
+Функции модуля не зависят от Streamlit и лежат на верхнем уровне,
+чтобы их можно было запускать в отдельных процессах.
+"""
+
+import ast
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from cache import content_hash
+from diagnostics import add_span, count, span
+
+
+# Колонки таблицы пиков в порядке, в котором они идут в DataFrame
+PEAK_COLUMNS = ("Sample_name", "Create_time", "Compound_name", "Response", "Conc")
+
+
+# Узлы, допустимые в формуле калибровочной кривой: числа, x и арифметика
+CURVE_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.UAdd, ast.USub,
+)
+
+
+def parse_xml(file):
+    """
+    Читает пики и калибровочные кривые из XML за один потоковый проход.
+
+    Пики берутся из SAMPLE/COMPOUND/PEAK, кривые — из первого
+    CALIBRATIONCURVE внутри каждого CALIBRATIONDATA/COMPOUND. Разобранные
+    элементы сразу удаляются из дерева, поэтому память не растёт
+    с размером файла.
+
+    :param file: Путь или файловый объект с XML
+    :return: DataFrame пиков, отсортированный по Compound_name и Sample_name,
+        и словарь {имя соединения: формула кривой}
+    """
+    columns = {name: [] for name in PEAK_COLUMNS}
+    curves = {}
+
+    stack = []  # Открытые элементы от корня до текущего
+    sample = None  # (имя, время создания) текущего SAMPLE
+    compound_name = None  # Имя COMPOUND внутри текущего SAMPLE
+    curve_compound = None  # Имя CALIBRATIONDATA/COMPOUND, для которого ещё нет кривой
+    try:
+        for event, elem in ET.iterparse(file, events=("start", "end")):
+            if event == "start":
+                parent = stack[-1].tag if stack else None
+                # Корень не учитывается, как в root.findall(".//...")
+                nested = len(stack) > 0
+                if elem.tag == "SAMPLE" and nested:
+                    sample = (elem.attrib.get("name", ""), elem.attrib.get("createtime", ""))
+                elif elem.tag == "COMPOUND" and parent == "SAMPLE" and sample is not None:
+                    compound_name = elem.attrib.get("name", "")
+                elif elem.tag == "PEAK" and parent == "COMPOUND" and compound_name is not None:
+                    columns["Sample_name"].append(sample[0])
+                    columns["Create_time"].append(sample[1])
+                    columns["Compound_name"].append(compound_name)
+                    columns["Response"].append(elem.attrib.get("response", ""))
+                    columns["Conc"].append(elem.attrib.get("analconc", ""))
+                elif elem.tag == "COMPOUND" and parent == "CALIBRATIONDATA" and len(stack) > 1:
+                    curve_compound = elem.attrib.get("name", "")
+                elif elem.tag == "CALIBRATIONCURVE" and curve_compound is not None:
+                    curves[curve_compound] = elem.attrib.get("curve", "")
+                    curve_compound = None
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if elem.tag == "SAMPLE":
+                sample = None
+            elif elem.tag == "COMPOUND":
+                compound_name = None
+                curve_compound = None
+            # Разобранный элемент больше не нужен
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+    except ET.ParseError as e:
+        raise ValueError(f"XML parsing error: {e}")
+
+    df = pd.DataFrame(columns)
+    df.sort_values(by=["Compound_name", "Sample_name"], inplace=True)
+    return df, curves
+
+
+def parse_xml_bytes(data):
+    """parse_xml для содержимого файла; верхний уровень нужен для пула процессов."""
+    return parse_xml(BytesIO(data))
+
+
+def load_xml_batch(files, workers=1, cache=None):
+    """
+    Разбирает несколько XML с учётом кэша, при workers > 1 — в пуле процессов.
+
+    Файлы с одинаковым содержимым разбираются один раз. Результаты
+    возвращаются в порядке files, поэтому объединять их можно так же,
+    как при последовательном разборе.
+
+    :param files: Список пар (имя файла, содержимое)
+    :param workers: Количество процессов
+    :param cache: Экземпляр cache.ByteLRUCache или None
+    :return: Список троек (имя файла, результат parse_xml или None, текст ошибки
+        или None) в порядке files; DataFrame в результатах — копии, их можно изменять
+    """
+    keys = [(content_hash(data), "xml") for _, data in files]
+
+    results = {}  # ключ -> результат parse_xml или исключение
+    pending = {}  # ключ -> содержимое файла, которого нет в кэше
+    for key, (_, data) in zip(keys, files):
+        if key in results or key in pending:
+            continue
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending[key] = data
+
+    count("xml_files", len(files))
+    count("xml_cache_hits", len(results))
+
+    def store(key, result):
+        results[key] = result
+        count("rows_parsed", len(result[0]))
+        if cache is not None:
+            df, curves = result
+            size = int(df.memory_usage(deep=True).sum()) + sum(
+                len(name) + len(curve) for name, curve in curves.items()
+            )
+            cache.put(key, result, size)
+
+    if workers > 1 and len(pending) > 1:
+        context = multiprocessing.get_context("spawn")
+        # В пуле замеряется общее время разбора всех файлов
+        with span("xml_parse"), ProcessPoolExecutor(
+            max_workers=min(workers, len(pending)), mp_context=context
+        ) as pool:
+            futures = {key: pool.submit(parse_xml_bytes, data) for key, data in pending.items()}
+            for key, future in futures.items():
+                try:
+                    store(key, future.result())
+                except Exception as e:
+                    results[key] = e
+    else:
+        for key, data in pending.items():
+            try:
+                with span("xml_parse"):
+                    result = parse_xml_bytes(data)
+                store(key, result)
+            except Exception as e:
+                results[key] = e
+
+    batch = []
+    for key, (name, _) in zip(keys, files):
+        result = results[key]
+        if isinstance(result, Exception):
+            batch.append((name, None, str(result)))
+        else:
+            # Закэшированный результат общий для всех сессий и не должен меняться
+            df, curves = result
+            batch.append((name, (df.copy(), dict(curves)), None))
+    return batch
+
+
+@lru_cache(maxsize=256)
+def compile_curve(curve):
+    """
+    Компилирует формулу калибровочной кривой от x, например "1.2*x + 0.03".
+
+    Разрешены только числа, переменная x, скобки и операции + - * / **.
+    Результат кэшируется по тексту формулы.
+
+    :return: Функция, которая вычисляет формулу для массива NumPy
+    :raises ValueError: Если формула не разбирается или содержит что-то ещё
+    """
+    try:
+        tree = ast.parse(curve.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid curve {curve!r}: {e}")
+    for node in ast.walk(tree):
+        if not isinstance(node, CURVE_NODES):
+            raise ValueError(f"Invalid curve {curve!r}: {type(node).__name__} is not allowed")
+        if isinstance(node, ast.Name) and node.id != "x":
+            raise ValueError(f"Invalid curve {curve!r}: unknown name {node.id}")
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise ValueError(f"Invalid curve {curve!r}: {node.value!r} is not a number")
+            # Целые константы считаются как float, чтобы не было длинной арифметики
+            node.value = float(node.value)
+    code = compile(tree, "<curve>", "eval")
+
+    def evaluate(x):
+        return eval(code, {"__builtins__": {}}, {"x": x})
+
+    return evaluate
+
+
+def to_float_array(values):
+    """Преобразует значения через float(); пустые и нечисловые становятся NaN."""
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    return np.fromiter(map(to_float, values), dtype=float, count=len(values))
+
+
+def calculate_responses(new_conc, curve):
+    """
+    Вычисляет newResponse по калибровочной кривой для всей колонки newConc.
+
+    :param new_conc: Значения newConc; пустые строки означают отсутствие значения
+    :param curve: Текст формулы, см. compile_curve
+    :return: Список того же размера: float или "", если newConc пустое,
+        формула некорректна или результат не конечен
+    """
+    x = to_float_array(new_conc)
+    try:
+        with np.errstate(all="ignore"):
+            result = np.broadcast_to(
+                np.asarray(compile_curve(curve)(x), dtype=float), x.shape
+            )
+    except (ValueError, ArithmeticError):
+        return [""] * len(x)
+    # Строки без newConc остаются пустыми, даже если формула не зависит от x
+    valid = np.isfinite(result) & ~np.isnan(x)
+    return [value if ok else "" for value, ok in zip(result.tolist(), valid.tolist())]
+
+
+def build_conc_lookup(json_df):
+    """
+    Строит таблицу идентификаторов JSON для поиска newConc.
+
+    Идентификатор имеет вид -Subject-Period-TT, где TT — timePoint - 1
+    с ведущим нулём. Для повторяющихся идентификаторов берётся последнее
+    значение CalcConc, а порядок — по первому появлению, как у dict(zip(...)).
+
+    :param json_df: DataFrame с колонками Subject, Period, timePoint, CalcConc
+    :return: DataFrame с колонками Identifier, CalcConc, Segments (количество
+        частей через "-") в порядке первого появления, и список идентификаторов,
+        у которых в JSON несколько разных значений CalcConc
+    """
+    identifiers = (
+        "-" + json_df["Subject"].astype(str)
+        + "-" + json_df["Period"].astype(str)
+        + "-" + (json_df["timePoint"].astype(int) - 1).astype(str).str.zfill(2)
+    )
+    table = pd.DataFrame({
+        "Identifier": identifiers.to_numpy(),
+        "CalcConc": pd.Series(json_df["CalcConc"].tolist(), dtype=object),
+    })
+
+    conflicts = table.groupby("Identifier", sort=False)["CalcConc"].nunique(dropna=False)
+    ambiguous = conflicts.index[conflicts > 1].tolist()
+
+    last_values = table.drop_duplicates("Identifier", keep="last").set_index("Identifier")["CalcConc"]
+    lookup = table[["Identifier"]].drop_duplicates("Identifier").reset_index(drop=True)
+    lookup["CalcConc"] = lookup["Identifier"].map(last_values)
+    lookup["Segments"] = lookup["Identifier"].str.count("-")
+    return lookup, ambiguous
+
+
+def match_new_conc(sample_names, lookup):
+    """
+    Находит CalcConc для каждого образца по окончанию его имени.
+
+    Результат совпадает с поиском первого идентификатора, которым
+    оканчивается имя образца: окончание из стольких же частей через "-"
+    выделяется регулярным выражением и соединяется с таблицей по хэшу.
+
+    :param sample_names: Series имён образцов
+    :param lookup: Таблица из build_conc_lookup
+    :return: Series значений CalcConc с индексом sample_names ("" без совпадения)
+        и список имён образцов без совпадения
+    """
+    positions = pd.Series(np.nan, index=sample_names.index)
+    for segments in lookup["Segments"].unique():
+        ids = lookup.loc[lookup["Segments"] == segments, "Identifier"]
+        id_positions = pd.Series(ids.index, index=ids.to_numpy())
+        suffix = sample_names.astype(str).str.extract(f"((?:-[^-]*){{{segments}}})$", expand=False)
+        # Из нескольких подходящих идентификаторов выбираем первый по порядку
+        positions = np.fmin(positions, suffix.map(id_positions))
+
+    matched = positions.notna()
+    values = pd.Series("", index=sample_names.index, dtype=object)
+    values[matched] = lookup["CalcConc"].to_numpy()[positions[matched].astype(int)]
+    return values, sample_names[~matched].tolist()
+
+
+# Колонки, которые округляются при экспорте, и префиксы их настроек в сессии
+ROUNDING_COLUMNS = {
+    "Response": "response",
+    "Conc": "conc",
+    "newResponse": "new_response",
+    "newConc": "new_conc",
+}
+
+
+def format_columns(df, settings):
+    """
+    Округляет и форматирует числовые колонки по настройкам каждого соединения.
+
+    Для каждого значения результат равен f"{round(float(x), rounding):.{digits}f}",
+    значения, которые не преобразуются в float, остаются как есть. Каждая
+    колонка преобразуется в числа один раз и записывается одним присваиванием.
+
+    :param df: DataFrame с колонкой Compound_name; изменяется на месте
+    :param settings: DataFrame с индексом Compound_name и колонками
+        <префикс>_rounding и <префикс>_digits для префиксов из ROUNDING_COLUMNS
+    :return: Колонки из ROUNDING_COLUMNS, которых нет в df
+    """
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    codes, compounds = pd.factorize(df["Compound_name"])
+    missing = []
+    for column, prefix in ROUNDING_COLUMNS.items():
+        if column not in df.columns:
+            missing.append(column)
+            continue
+
+        values = df[column].to_numpy(dtype=object, copy=True)
+        numbers = np.array(list(map(to_float, values)), dtype=object)
+        parsed = np.not_equal(numbers, None)
+
+        # Настройки для каждой строки через код её соединения
+        column_settings = settings.reindex(compounds)[[f"{prefix}_rounding", f"{prefix}_digits"]]
+        rounding = column_settings.iloc[:, 0].to_numpy()[codes]
+        digits = column_settings.iloc[:, 1].to_numpy()[codes]
+
+        for ndigits, precision in column_settings.drop_duplicates().itertuples(index=False):
+            rows = np.flatnonzero(parsed & (rounding == ndigits) & (digits == precision))
+            rounded = map(round, numbers[rows].tolist(), repeat(int(ndigits)))
+            values[rows] = list(map(format, rounded, repeat(f".{int(precision)}f")))
+
+        df[column] = values
+    return missing
+
+
+# Время в формате datetime.strptime(..., "%H:%M:%S"): часы 0-23, минуты
+# и секунды 0-59, одна или две цифры в каждой части
+TIME_PATTERN = r"\A(2[0-3]|[01]\d|\d):([0-5]\d|\d):([0-5]\d|\d)\Z"
+
+
+def parse_times(values):
+    """
+    Переводит время вида ЧЧ:ММ:СС в секунды от начала суток.
+
+    :param values: Series значений; каждое приводится к str
+    :return: Массив секунд (float), NaN для значений не в формате %H:%M:%S
+    """
+    parts = values.astype(str).str.extract(TIME_PATTERN)
+    # \d совпадает и с другими цифрами Юникода (например, "٩:٥:٧"); strptime
+    # переводит их через int(), а pd.to_numeric на них падает
+    hours, minutes, seconds = (
+        parts[i].map(int, na_action="ignore").to_numpy(dtype=float) for i in range(3)
+    )
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def fill_create_times(create_time, new_create_time, first_hour):
+    """
+    Пересчитывает newCreate_time со второй строки по Create_time.
+
+    Каждое новое время — это Create_time строки, сдвинутое на столько часов,
+    на сколько час первого newCreate_time отличается от часа Create_time
+    предыдущей строки, по модулю суток.
+
+    :param create_time: Series Create_time с индексом 0..n-1
+    :param new_create_time: Series newCreate_time того же размера
+    :param first_hour: Час из первого значения newCreate_time
+    :return: Новая колонка newCreate_time и номера строк, которые не удалось
+        пересчитать из-за неверного Create_time в них или в предыдущей строке
+    """
+    seconds = parse_times(create_time)
+    prev_seconds = np.roll(seconds, 1)
+    shifted = seconds + (first_hour - prev_seconds // 3600) * 3600
+
+    rows = np.arange(len(seconds))
+    valid = (rows > 0) & ~np.isnan(seconds) & ~np.isnan(prev_seconds)
+    invalid_rows = rows[(rows > 0) & ~valid].tolist()
+
+    total = pd.Series(shifted[valid] % 86400, dtype="int64")
+    formatted = (
+        (total // 3600).astype(str).str.zfill(2)
+        + ":" + (total // 60 % 60).astype(str).str.zfill(2)
+        + ":" + (total % 60).astype(str).str.zfill(2)
+    )
+    result = new_create_time.to_numpy(dtype=object, copy=True)
+    result[valid] = formatted.to_numpy()
+    return pd.Series(result, index=new_create_time.index, name=new_create_time.name), invalid_rows
+
+
+def column_fingerprint(values):
+    """
+    Хэш значений колонки с учётом их порядка.
+
+    Не зависит от способа хранения: пустые значения (NaN, None, pd.NA)
+    хэшируются одинаково, строки Arrow — как те же строки в object.
+    """
+    texts = values.astype(object).where(values.notna(), None).astype(str)
+    hashed = pd.util.hash_pandas_object(texts, index=False)
+    return content_hash(hashed.to_numpy().tobytes())
+
+
+def apply_cell_edits(df, edited, offset=0):
+    """
+    Переносит изменённые в окне редактора ячейки в лист на месте.
+
+    Сравниваются только строки и колонки окна; ячейки, где оба значения
+    пустые (NaN/None), изменёнными не считаются.
+
+    :param df: Лист целиком с индексом 0..n-1; изменяется на месте
+    :param edited: Строки окна из редактора; индекс — номер строки в окне
+        (число или строка с числом), колонки — колонки листа
+    :param offset: Номер первой строки окна в листе
+    :return: Список правок (номер строки, колонка, новое значение)
+    """
+    if edited is None or edited.empty:
+        return []
+    positions = offset + np.asarray(edited.index, dtype="int64")
+    deltas = []
+    for column in edited.columns.intersection(df.columns, sort=False):
+        column_position = df.columns.get_loc(column)
+        old = df.iloc[positions, column_position].to_numpy(dtype=object, na_value=None)
+        new = edited[column].to_numpy(dtype=object)
+        changed = ~((old == new) | (pd.isna(old) & pd.isna(new)))
+        if not changed.any():
+            continue
+
+        values = new[changed]
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.StringDtype):
+            values = np.array([None if pd.isna(v) else str(v) for v in values], dtype=object)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            added = pd.Index(values[pd.notna(values)]).difference(dtype.categories)
+            if len(added):
+                df[column] = df[column].cat.add_categories(added)
+        # Одна запись на колонку: массивы Arrow при записи копируются целиком
+        df.iloc[positions[changed], column_position] = values
+        deltas.extend(zip(positions[changed].tolist(), repeat(column), values))
+    return deltas
+
+
+# Лист в сессии: соединения — category, текст — строки Arrow
+CATEGORY_COLUMNS = ("Compound_name",)
+ARROW_STRING = "string[pyarrow]"
+
+
+def compact_sheet(df):
+    """
+    Переводит лист в компактное представление для хранения в сессии.
+
+    Compound_name хранится как category, колонки из одних строк (и пустых
+    значений) — как строки Arrow. Числовые колонки остаются числовыми,
+    колонки со смешанными значениями — object, чтобы выгрузка не менялась.
+    Уже компактные колонки не копируются.
+
+    :param df: Лист; изменяется на месте
+    :return: Тот же DataFrame
+    """
+    for column in df.columns:
+        values = df[column]
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype("category")
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+            df[column] = values.astype(ARROW_STRING)
+    return df
+
+
+def frame_memory_bytes(df):
+    """Объём DataFrame в памяти вместе со строками и индексом."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def current_rss_bytes():
+    """Текущий объём памяти процесса (RSS) в байтах или None, если его не узнать (не Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """
+    Замеряет, на сколько RSS процесса вырос за время блока сверх начального.
+
+    RSS опрашивается в отдельном потоке каждые interval секунд. В отличие от
+    ru_maxrss, результат не зависит от того, что процесс делал до блока, но
+    включает всё, что процесс делал во время блока, в том числе в других сессиях.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start = self.peak = current_rss_bytes()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    @property
+    def growth_bytes(self):
+        """Рост RSS от начала блока до пика или None, если RSS не узнать."""
+        return None if self.start is None else self.peak - self.start
+
+
+def write_workbook(output, sheets, fit_widths=True, column_format=None):
+    """Записывает листы в output; параметры — как у export_xlsx."""
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    # Формат заголовка, которым пользуется pandas
+    header_format = workbook.add_format({
+        "bold": True, "border": 1, "align": "center", "valign": "top",
+    })
+    cell_format = workbook.add_format(column_format) if column_format else None
+    for sheet_name, df in sheets:
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, list(df.columns), header_format)
+
+        columns = []
+        for i, column in enumerate(df.columns):
+            values = df[column]
+            column_width = None
+            if fit_widths:
+                texts = values
+                if isinstance(values.dtype, pd.StringDtype):
+                    # Пустые строки Arrow считаются как NaN в колонке object
+                    texts = values.astype(object).where(values.notna(), np.nan)
+                longest = texts.astype(str).str.len().max() if len(values) else 0
+                column_width = max(longest, len(column)) + 2
+            if column_width is not None or cell_format is not None:
+                worksheet.set_column(i, i, column_width, cell_format)
+            # Пустые значения pandas записывает пустыми ячейками
+            columns.append(values.astype(object).where(values.notna(), None).tolist())
+
+        for row, values in enumerate(zip(*columns), start=1):
+            worksheet.write_row(row, 0, values)
+    workbook.close()
+
+
+def export_xlsx(sheets, spill_threshold=None, fit_widths=True, column_format=None):
+    """
+    Записывает листы в книгу xlsx построчно в режиме constant_memory.
+
+    Содержимое ячеек и заголовки такие же, как у DataFrame.to_excel(index=False).
+
+    :param sheets: Пары (имя листа, DataFrame)
+    :param spill_threshold: Размер в байтах, после которого книга пишется
+        во временный файл на диске; None — всегда в памяти
+    :param fit_widths: Ширина колонки — длина самого длинного значения
+        или заголовка плюс 2; иначе ширина по умолчанию
+    :param column_format: Свойства формата xlsxwriter для всех колонок или None
+    :return: Файловый объект с книгой, установленный на начало,
+        и статистика: export_seconds, output_bytes, rss_growth_bytes (см. RssSampler)
+    """
+    start = time.perf_counter()
+    if spill_threshold is None:
+        output = BytesIO()
+    else:
+        output = tempfile.SpooledTemporaryFile(max_size=spill_threshold)
+
+    with RssSampler() as rss:
+        write_workbook(output, sheets, fit_widths, column_format)
+
+    output_bytes = output.tell()
+    output.seek(0)
+    export_seconds = time.perf_counter() - start
+    add_span("xlsx_write", export_seconds)
+    count("bytes_written", output_bytes)
+    return output, {
+        "export_seconds": export_seconds,
+        "output_bytes": output_bytes,
+        "rss_growth_bytes": rss.growth_bytes,
+    }
+
+
+# Порядок колонок листа выгрузки
+SHEET_COLUMNS = (
+    "Compound_name", "Sample_name", "Create_time", "newCreate_time",
+    "Response", "newResponse", "Conc", "newConc",
+)
+
+
+def build_sheets(file_data, json_files, curves, rounding_settings, progress=None):
+    """
+    Считает newConc/newResponse, округляет значения и собирает листы выгрузки.
+
+    :param file_data: Словарь {имя XML: DataFrame пиков}; не изменяется
+    :param json_files: Словарь {Compound_name: DataFrame JSON}
+    :param curves: Словарь {Compound_name: формула кривой} для соединений из json_files
+    :param rounding_settings: Настройки округления для format_columns по всем соединениям
+    :param progress: Функция progress(units, message) или None; вызывается после
+        каждого соединения каждого файла и после каждого листа
+    :return: Словарь {имя листа: компактный DataFrame} и список предупреждений
+    """
+    messages = []
+    excel_sheets = {}
+
+    # Идентификаторы JSON строятся один раз для всех файлов
+    conc_lookups = {}
+    for compound, json_df in json_files.items():
+        with span("identifier_match"):
+            conc_lookups[compound], ambiguous = build_conc_lookup(json_df)
+        if ambiguous:
+            messages.append(
+                f"JSON for {compound} has different CalcConc values for identifiers "
+                f"{', '.join(ambiguous[:5])}{'...' if len(ambiguous) > 5 else ''}; "
+                f"the last value is used."
+            )
+
+    for file_name, df in file_data.items():
+        # Разобранные XML хранятся в сессии и не должны меняться расчётом
+        df = df.copy()
+        for compound in json_files:
+            compound_df = df[df["Compound_name"] == compound].copy()
+
+            with span("identifier_match"):
+                compound_df["newConc"], unmatched = match_new_conc(
+                    compound_df["Sample_name"], conc_lookups[compound]
+                )
+            count("hits", len(compound_df) - len(unmatched))
+            count("misses", len(unmatched))
+            if unmatched:
+                messages.append(
+                    f"{file_name}: no JSON identifier for {len(unmatched)} {compound} samples: "
+                    f"{', '.join(unmatched[:5])}{'...' if len(unmatched) > 5 else ''}"
+                )
+
+            compound_df["newConc"] = compound_df["newConc"].apply(lambda x: "" if x == 0 else x)
+            # Кривая компилируется один раз и считается сразу для всей колонки
+            with span("curve_eval"):
+                compound_df["newResponse"] = calculate_responses(compound_df["newConc"], curves[compound])
+
+            df.loc[df["Compound_name"] == compound, "newConc"] = compound_df["newConc"]
+            df.loc[df["Compound_name"] == compound, "newResponse"] = compound_df["newResponse"]
+            if progress is not None:
+                progress(1, f"{file_name}: {compound}")
+
+        # Применяем округление отдельно для каждой группы Compound_name
+        with span("rounding"):
+            missing_columns = format_columns(df, rounding_settings)
+        for column in missing_columns:
+            messages.append(f"Column '{column}' not found in {file_name}.")
+
+        sheet_name = file_name.replace("/", "_").replace("\\", "_")[:31]
+
+        # Добавляем новую пустую колонку newCreate_time
+        df["newCreate_time"] = [""] * len(df)
+
+        # Изменение порядка колонок
+        existing_columns = [col for col in SHEET_COLUMNS if col in df.columns]
+        # Лист хранится в сессии в компактном виде: category и строки Arrow
+        excel_sheets[sheet_name] = compact_sheet(df[existing_columns].copy())
+        count("rows_written", len(df))
+        if progress is not None:
+            progress(1, f"{file_name}: rounding")
+
+    return excel_sheets, messages
+
+
+# Пары колонок (старое значение, новое значение) и ключ страницы в настройках
+VALUE_PAIRS = (
+    ("Response", "newResponse", "newConc_newResponse_page"),
+    ("Conc", "newConc", "newConc_newResponse_page"),
+    ("Create_time", "newCreate_time", "newCreate_time_page"),
+)
+
+
+def build_value_table(df, pages):
+    """
+    Строит таблицу Old Value / New Value / Page для одного листа.
+
+    Строки идут блоками: сначала все пары Response, затем Conc, затем
+    Create_time, внутри блока — в порядке строк листа. Пары с пустым
+    старым или новым значением отбрасываются.
+
+    :param df: Лист из excel_sheets
+    :param pages: Словарь {Compound_name: {ключ страницы: номер страницы}}
+    :return: DataFrame с колонками Old Value, New Value, Page или None, если в листе
+        нет строк с newConc и newResponse
+    """
+    filtered_df = df[df["newConc"].notna() & df["newResponse"].notna()]
+    if filtered_df.empty:
+        return None
+
+    compound_pages = pd.DataFrame.from_dict(
+        {compound: pages[compound] for compound in filtered_df["Compound_name"].unique()},
+        orient="index",
+    )
+    result_df = pd.DataFrame({
+        "Old Value": np.concatenate([filtered_df[old].to_numpy(dtype=object) for old, _, _ in VALUE_PAIRS]),
+        "New Value": np.concatenate([filtered_df[new].to_numpy(dtype=object) for _, new, _ in VALUE_PAIRS]),
+        "Page": np.concatenate([
+            filtered_df["Compound_name"].map(compound_pages[key]).to_numpy()
+            for _, _, key in VALUE_PAIRS
+        ]),
+    }).infer_objects()
+
+    # Пустыми считаются NaN, пустые строки и строки из пробелов
+    values = result_df[["Old Value", "New Value"]]
+    blank = values.isna() | (values.astype(str).apply(lambda column: column.str.strip()) == "")
+    return result_df[~blank.any(axis=1)]
@@ -0,0 +1,310 @@
+"""
+Очередь фоновых заданий для долгих операций страниц.
+
+Один экземпляр очереди разделяется всеми сессиями Streamlit: задания
+выполняются в общем пуле потоков, поэтому одновременно работает не больше
+max_workers заданий, остальные ждут своей очереди. Процессы для пулов
+заданий берутся из общего бюджета очереди (см. JobProgress.reserve_processes),
+поэтому все задания вместе не запускают больше max_processes процессов.
+Состояние и результат задания хранятся в очереди и не зависят от
+перезапусков страницы; файлы результатов задания пишут в рабочий каталог
+очереди (см. JobQueue.work_dir).
+"""
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    """Задание отменено пользователем."""
+
+
+class ProcessBudget:
+    """
+    Общее для всех заданий число процессов, которые можно запустить в пулах.
+
+    :param total: Сколько процессов могут работать одновременно
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.available = total
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def reserve(self, requested):
+        """
+        Резервирует процессы на время блока и отдаёт их число для пула.
+
+        Выдаётся не больше свободных процессов. Если свободно меньше двух,
+        пул не нужен: выдаётся 1, и задание работает в своём потоке, не
+        занимая бюджет.
+
+        :param requested: Сколько процессов хочет задание
+        """
+        with self._lock:
+            granted = min(requested, self.available)
+            if granted < 2:
+                granted = 0
+            self.available -= granted
+        try:
+            yield granted or 1
+        finally:
+            with self._lock:
+                self.available += granted
+
+
+class JobProgress:
+    """
+    Ход выполнения задания; передаётся функции задания.
+
+    Функция вызывает advance по мере работы. Если задание отменено,
+    advance и check выбрасывают JobCancelled, и функция завершается.
+    """
+
+    def __init__(self, total=0, budget=None):
+        self.total = total
+        self.done = 0
+        self.message = ""
+        self.started = None
+        self._cancel = threading.Event()
+        self._budget = budget
+
+    def advance(self, units=1, message=None):
+        """Отмечает выполненные единицы работы (файлы, страницы, строки)."""
+        self.check()
+        self.done += units
+        if message is not None:
+            self.message = message
+
+    def check(self):
+        """Выбрасывает JobCancelled, если задание отменено."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    @contextmanager
+    def reserve_processes(self, requested):
+        """
+        Число процессов для пула задания в пределах бюджета очереди, см.
+        ProcessBudget.reserve; без бюджета выдаётся requested.
+        """
+        if self._budget is None:
+            yield requested
+            return
+        with self._budget.reserve(requested) as granted:
+            yield granted
+
+    def eta_seconds(self):
+        """Оставшееся время по средней скорости с начала задания или None."""
+        if self.started is None or not self.done or self.total <= self.done:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed / self.done * (self.total - self.done)
+
+
+class JobRecord(dict):
+    """
+    Запись сессии о задании: словарь с ключом "id" и любыми другими полями.
+
+    clear() удаляет задание из очереди вместе с результатом, поэтому запись
+    можно передать SessionRegistry как хранилище сессии.
+    """
+
+    def __init__(self, queue, **fields):
+        super().__init__(**fields)
+        self.queue = queue
+
+    def clear(self):
+        if "id" in self:
+            self.queue.remove(self["id"])
+        super().clear()
+
+
+class JobQueue:
+    """
+    Очередь заданий с ограниченным числом одновременно выполняемых.
+
+    :param max_workers: Сколько заданий выполняется одновременно
+    :param ttl_seconds: Сколько хранить завершённое задание и его результат
+    :param max_processes: Сколько процессов все задания вместе могут
+        запустить в пулах; по умолчанию — число процессоров
+    :param work_dir: Каталог для временных файлов заданий или None. Каталог
+        принадлежит очереди: при создании очереди файлы, оставшиеся в нём
+        от прежней очереди или прежнего запуска сервера, удаляются
+    """
+
+    def __init__(self, max_workers, ttl_seconds, max_processes=None, work_dir=None):
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self.processes = ProcessBudget(max_processes or os.cpu_count() or 1)
+        self.work_dir = work_dir
+        if work_dir is not None:
+            os.makedirs(work_dir, mode=0o700, exist_ok=True)
+            self._sweep_work_dir()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="edit_pdf_job")
+        self._jobs = {}  # id задания -> словарь состояния
+        self._lock = threading.Lock()
+
+    def submit(self, func, total=0, label="", cleanup=None):
+        """
+        Ставит задание в очередь.
+
+        :param func: Функция задания; получает JobProgress, её результат
+            становится результатом задания
+        :param total: Объём работы в единицах JobProgress.advance
+        :param label: Название для отображения
+        :param cleanup: Функция, которая получает результат задания, когда
+            задание удаляется из очереди (например, удаляет файлы результата)
+        :return: Идентификатор задания
+        """
+        job_id = uuid.uuid4().hex
+        progress = JobProgress(total, self.processes)
+        job = {
+            "id": job_id, "label": label, "state": QUEUED, "progress": progress,
+            "submitted": time.monotonic(), "finished": None, "result": None, "error": None,
+            "cleanup": cleanup,
+        }
+        with self._lock:
+            self._purge(time.monotonic())
+            self._jobs[job_id] = job
+            job["future"] = self._executor.submit(self._run, job, func)
+        return job_id
+
+    def status(self, job_id):
+        """
+        Возвращает снимок состояния задания или None, если задания нет.
+
+        В снимке: state, label, done, total, message, eta_seconds,
+        elapsed_seconds, position (место в очереди для ожидающих), error.
+        """
+        with self._lock:
+            self._purge(time.monotonic())
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            progress = job["progress"]
+            position = None
+            if job["state"] == QUEUED:
+                queued = [other for other in self._jobs.values() if other["state"] == QUEUED]
+                queued.sort(key=lambda other: other["submitted"])
+                position = queued.index(job) + 1
+            end = job["finished"] or time.monotonic()
+            return {
+                "id": job_id,
+                "label": job["label"],
+                "state": job["state"],
+                "done": progress.done,
+                "total": progress.total,
+                "message": progress.message,
+                "eta_seconds": progress.eta_seconds() if job["state"] == RUNNING else None,
+                "elapsed_seconds": end - progress.started if progress.started else 0.0,
+                "position": position,
+                "error": job["error"],
+            }
+
+    def wait(self, job_id, timeout=None):
+        """
+        Ждёт завершения задания не дольше timeout секунд.
+
+        :return: Состояние задания, см. status, или None, если задания нет
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        wait([job["future"]], timeout)
+        return self.status(job_id)
+
+    def result(self, job_id):
+        """Результат завершённого задания или None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job["result"] if job is not None and job["state"] == DONE else None
+
+    def cancel(self, job_id):
+        """
+        Отменяет задание: ожидающее не запустится, выполняемое остановится
+        при следующем вызове JobProgress.advance или check.
+
+        :return: True, если задание было активно
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] not in ACTIVE_STATES:
+                return False
+            job["progress"]._cancel.set()
+            if job["future"].cancel():
+                job["state"] = CANCELLED
+                job["finished"] = time.monotonic()
+            return True
+
+    def remove(self, job_id):
+        """Отменяет задание, если оно активно, и удаляет его вместе с результатом."""
+        self.cancel(job_id)
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._discard(job)
+
+    def _run(self, job, func):
+        progress = job["progress"]
+        with self._lock:
+            if progress._cancel.is_set():
+                # Задание отменили, когда поток уже взял его, но ещё не запустил
+                job["state"] = CANCELLED
+                job["finished"] = time.monotonic()
+                return
+            job["state"] = RUNNING
+            progress.started = time.monotonic()
+        try:
+            result = func(progress)
+        except JobCancelled:
+            state, result, error = CANCELLED, None, None
+        except Exception as e:
+            state, result, error = FAILED, None, f"{type(e).__name__}: {e}"
+        else:
+            state, error = DONE, None
+        with self._lock:
+            job["state"] = state
+            job["result"] = result
+            job["error"] = error
+            job["finished"] = time.monotonic()
+            if self._jobs.get(job["id"]) is not job:
+                # Задание удалили из очереди, пока оно выполнялось
+                self._discard(job)
+
+    def _purge(self, now):
+        # Завершённые задания хранятся ttl_seconds, затем удаляются с результатом
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished"] is not None and now - job["finished"] > self.ttl_seconds
+        ]
+        for job_id in expired:
+            self._discard(self._jobs.pop(job_id))
+
+    def _sweep_work_dir(self):
+        # Файлы прежних заданий: очередь, которая их создала, уже не существует
+        with os.scandir(self.work_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def _discard(self, job):
+        if job["cleanup"] is not None and job["result"] is not None:
+            job["cleanup"](job["result"])
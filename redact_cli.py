@@ -0,0 +1,155 @@
+"""
+Пакетная замена текста в PDF без интерфейса Streamlit.
+
+Использует тот же движок, что и страница «Редактирование PDF»: лист Excel
+(или файл замен) выбирается по имени PDF без расширения, результат
+сохраняется как updated_<имя PDF> в выходном каталоге.
+
+Примеры:
+    python redact_cli.py pdfs/ --workbook mapping.xlsx -o out/ -j 4
+    python redact_cli.py pdfs/ --mapping-dir mappings/ -o out/
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+from redaction import (
+    DEFAULT_SAVE_PROFILE, SAVE_PROFILES, build_redaction_plan, iter_jobs,
+    load_mapping_file, load_mapping_sheets, pdf_sheet_name,
+)
+
+
+MAPPING_EXTENSIONS = (".csv", ".parquet")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Заменяет значения в PDF по таблицам Old Value / New Value / Page."
+    )
+    parser.add_argument("pdf_dir", help="Каталог с PDF файлами")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--workbook", help="Книга Excel, лист на каждый PDF")
+    source.add_argument(
+        "--mapping-dir", help="Каталог с файлами <имя PDF>.csv или <имя PDF>.parquet"
+    )
+    parser.add_argument("-o", "--output-dir", required=True, help="Каталог для результатов")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1, help="Количество параллельных процессов"
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=None,
+        help="Делить PDF по страницам между процессами частями такого размера; "
+             "PDF с оглавлением, ссылками или формами обрабатываются целиком"
+    )
+    parser.add_argument(
+        "--save-profile", choices=list(SAVE_PROFILES), default=DEFAULT_SAVE_PROFILE,
+        help="Профиль сохранения PDF"
+    )
+    return parser.parse_args(argv)
+
+
+def load_mappings(args, pdf_names):
+    """
+    Возвращает таблицы замен для PDF, у которых они есть.
+
+    :param pdf_names: Имена PDF файлов
+    :return: Словарь {имя листа: DataFrame}
+    """
+    sheet_names = [pdf_sheet_name(name) for name in pdf_names]
+    if args.workbook:
+        with open(args.workbook, "rb") as f:
+            return load_mapping_sheets(f.read(), sheet_names)
+
+    files = {}
+    for file_name in sorted(os.listdir(args.mapping_dir)):
+        if file_name.lower().endswith(MAPPING_EXTENSIONS):
+            files.setdefault(pdf_sheet_name(file_name), file_name)
+    return {
+        name: load_mapping_file(os.path.join(args.mapping_dir, files[name]))
+        for name in dict.fromkeys(sheet_names) if name in files
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    pdf_names = sorted(
+        name for name in os.listdir(args.pdf_dir) if name.lower().endswith(".pdf")
+    )
+    mappings = load_mappings(args, pdf_names)
+
+    matched = [name for name in pdf_names if pdf_sheet_name(name) in mappings]
+    for name in pdf_names:
+        if name not in matched:
+            print(f"{name}: таблица замен не найдена, файл пропущен", file=sys.stderr)
+    if not matched:
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    submitted = []  # Имена PDF в порядке передачи движку
+    errors = []  # Пары (имя PDF, текст ошибки)
+
+    def jobs():
+        # PDF читаются по одному, по мере того как движок готов их принять
+        for name in matched:
+            try:
+                with open(os.path.join(args.pdf_dir, name), "rb") as f:
+                    pdf_bytes = f.read()
+            except OSError as e:
+                report_error(name, e)
+                continue
+            submitted.append(name)
+            yield pdf_bytes, build_redaction_plan(mappings[pdf_sheet_name(name)])
+
+    def report_error(name, error):
+        errors.append((name, f"{type(error).__name__}: {error}"))
+        print(f"{name}: ошибка: {errors[-1][1]}", file=sys.stderr)
+
+    start = time.perf_counter()
+    totals = {"pages_touched": 0, "hits": 0, "misses": 0}
+    # spill_threshold=0: результат сразу пишется во временный файл и переносится.
+    # Ошибка в одном PDF не останавливает обработку остальных
+    results = iter_jobs(
+        jobs(), workers=args.workers, shard_size=args.shard_size, spill_threshold=0,
+        save_profile=args.save_profile, return_exceptions=True
+    )
+    for index, result in enumerate(results):
+        name = submitted[index]
+        if isinstance(result, Exception):
+            report_error(name, result)
+            continue
+        output, missing_pages, stats = result
+        try:
+            shutil.move(output, os.path.join(args.output_dir, f"updated_{name}"))
+        except OSError as e:
+            os.remove(output)
+            report_error(name, e)
+            continue
+        for key in totals:
+            totals[key] += stats[key]
+        print(
+            f"{name}: страниц {stats['pages_touched']}, замен {stats['hits']}, "
+            f"не найдено {stats['misses']}, {stats['total_seconds']:.2f} с"
+        )
+        if missing_pages:
+            print(
+                f"{name}: в таблице указаны отсутствующие страницы: {', '.join(missing_pages)}",
+                file=sys.stderr,
+            )
+
+    print(
+        f"Итого {len(matched) - len(errors)} из {len(matched)} файлов: "
+        f"страниц {totals['pages_touched']}, замен {totals['hits']}, "
+        f"не найдено {totals['misses']}, {time.perf_counter() - start:.2f} с"
+    )
+    for name, error in errors:
+        print(f"Ошибка {name}: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
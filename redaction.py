@@ -0,0 +1,818 @@
+"""
+Движок замены текста в PDF для страницы «Редактирование PDF».
+
+Функции модуля не зависят от Streamlit и лежат на верхнем уровне,
+чтобы их можно было запускать в отдельных процессах.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import string
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import fitz  # PyMuPDF
+import pandas as pd
+
+from cache import content_hash
+from diagnostics import add_span, count, current_trace, run_traced, span
+
+
+# Флаги текстового слоя — те же, что page.search_for использует по умолчанию
+SEARCH_FLAGS = (
+    fitz.TEXT_DEHYPHENATE
+    | fitz.TEXT_PRESERVE_WHITESPACE
+    | fitz.TEXT_PRESERVE_LIGATURES
+    | fitz.TEXT_MEDIABOX_CLIP
+)
+
+
+# Профили сохранения итогового PDF: параметры doc.save и подмножество шрифтов
+SAVE_PROFILES = {
+    # Только удаление неиспользуемых объектов, без поиска дубликатов.
+    # Без сборки мусора совсем сохранение медленнее: после apply_redactions
+    # в документе остаются крупные несжатые объекты
+    "fast": {"save": {"garbage": 2, "deflate": True}, "subset_fonts": False},
+    # Прежнее поведение: полная сборка мусора и сжатие потоков
+    "balanced": {"save": {"garbage": 4, "deflate": True}, "subset_fonts": False},
+    # Дополнительно сжимаются изображения и шрифты, шрифты урезаются до используемых глифов
+    "smallest": {
+        "save": {
+            "garbage": 4, "deflate": True, "deflate_images": True,
+            "deflate_fonts": True, "use_objstms": 1,
+        },
+        "subset_fonts": True,
+    },
+}
+DEFAULT_SAVE_PROFILE = "balanced"
+
+
+# Колонки листа Excel, которые нужны для замены
+MAPPING_COLUMNS = ("Old Value", "New Value", "Page")
+
+# Строки, которые pd.read_excel по умолчанию читает как пустые значения
+EXCEL_NA_VALUES = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+})
+
+
+def pdf_sheet_name(file_name):
+    """Имя листа Excel для PDF файла: имя файла без расширения."""
+    return file_name.rsplit('.', 1)[0]
+
+
+def list_sheet_names(workbook):
+    """
+    Возвращает имена листов книги Excel, не разбирая сами листы.
+
+    :param workbook: Содержимое файла xlsx
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(workbook)) as zf:
+            root = ET.fromstring(zf.read("xl/workbook.xml"))
+    except KeyError:
+        # Нестандартное расположение частей книги — читаем через openpyxl
+        with pd.ExcelFile(BytesIO(workbook), engine="openpyxl") as xls:
+            return list(xls.sheet_names)
+    ns = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    return [sheet.get("name") for sheet in root.iter(f"{ns}sheet")]
+
+
+def load_mapping_sheets(workbook, sheet_names, cache=None):
+    """
+    Читает из книги Excel только нужные листы и только колонки MAPPING_COLUMNS.
+
+    Значения читаются как строки, как в pd.read_excel(..., dtype=str).
+
+    :param workbook: Содержимое файла xlsx
+    :param sheet_names: Имена нужных листов; отсутствующие в книге пропускаются
+    :param cache: ByteLRUCache для списка листов и разобранных листов
+        с ключом по хэшу книги, или None
+    :return: Словарь {имя листа: DataFrame}
+    """
+    workbook_hash = content_hash(workbook)
+
+    available = cache.get((workbook_hash, "sheets")) if cache is not None else None
+    if available is None:
+        available = list_sheet_names(workbook)
+        if cache is not None:
+            cache.put((workbook_hash, "sheets"), available, sum(map(len, available)))
+
+    sheets = {}
+    to_parse = []
+    for name in dict.fromkeys(sheet_names):
+        if name not in available:
+            continue
+        cached = cache.get((workbook_hash, "sheet", name)) if cache is not None else None
+        if cached is not None:
+            sheets[name] = cached
+        else:
+            to_parse.append(name)
+
+    if to_parse:
+        parsed = pd.read_excel(
+            BytesIO(workbook), sheet_name=to_parse, dtype=str, engine="openpyxl",
+            usecols=lambda column: column in MAPPING_COLUMNS
+        )
+        for name in to_parse:
+            sheets[name] = parsed[name]
+            if cache is not None:
+                size = int(parsed[name].memory_usage(deep=True).sum())
+                cache.put((workbook_hash, "sheet", name), parsed[name], size)
+
+    return sheets
+
+
+def load_mapping_file(path):
+    """
+    Читает таблицу замен для одного PDF из файла CSV или Parquet.
+
+    Значения приводятся к строкам так же, как в load_mapping_sheets,
+    пустые ячейки остаются NaN.
+
+    :param path: Путь к файлу .csv или .parquet
+    :return: DataFrame с колонками MAPPING_COLUMNS
+    """
+    if path.lower().endswith(".parquet"):
+        return read_mapping_parquet(path)
+    return pd.read_csv(path, dtype=str, usecols=lambda column: column in MAPPING_COLUMNS)
+
+
+def read_mapping_parquet(source):
+    """
+    Читает таблицу замен из Parquet и приводит значения к строкам.
+
+    :param source: Путь к файлу или содержимое файла (bytes)
+    :return: DataFrame с колонками MAPPING_COLUMNS, пустые ячейки — NaN
+    """
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    data = pd.read_parquet(source, columns=list(MAPPING_COLUMNS))
+    return data.astype(str).where(data.notna())
+
+
+def mapping_to_parquet(table):
+    """
+    Сохраняет таблицу замен в Parquet с типами колонок: строки и номер страницы.
+
+    Значения из EXCEL_NA_VALUES сохраняются пустыми, чтобы таблица читалась
+    так же, как после записи в xlsx и pd.read_excel(..., dtype=str).
+
+    :param table: DataFrame с колонками MAPPING_COLUMNS
+    :return: Содержимое файла Parquet
+    """
+    def to_strings(values):
+        values = values.astype(str)
+        return values.where(~values.isin(EXCEL_NA_VALUES)).astype("string[pyarrow]")
+
+    typed = pd.DataFrame({
+        "Old Value": to_strings(table["Old Value"]),
+        "New Value": to_strings(table["New Value"]),
+        "Page": table["Page"].astype("int64"),
+    })
+    buffer = BytesIO()
+    typed.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def build_redaction_plan(sheet_data):
+    """
+    Группирует строки листа Excel по страницам за один проход.
+
+    Порядок старых значений на странице и порядок новых значений
+    для каждого из них совпадает с порядком строк в листе.
+
+    :param sheet_data: DataFrame с колонками Old Value, New Value, Page
+    :return: Словарь {номер страницы (str): [(старое значение, [новые значения]), ...]}
+    """
+    plan = {}
+    grouped = sheet_data.groupby(
+        [sheet_data['Page'].astype(str), 'Old Value'], sort=False
+    )['New Value']
+    for (page_key, raw_text), new_values in grouped:
+        plan.setdefault(page_key, []).append((raw_text, list(new_values)))
+    return plan
+
+
+def result_key(pdf_bytes, plan, params=None):
+    """
+    Ключ кэша результата: хэш PDF, хэш плана замен и параметры обработки.
+
+    :param params: Словарь параметров, влияющих на результат
+    """
+    plan_hash = hashlib.sha256(repr(plan).encode()).hexdigest()
+    return content_hash(pdf_bytes), plan_hash, tuple(sorted((params or {}).items()))
+
+
+def split_plan_pages(plan, page_count):
+    """
+    Делит страницы плана на существующие в документе и отсутствующие.
+
+    :return: Отсортированный список индексов страниц и список ключей плана,
+        которые не являются номером страницы документа
+    """
+    pages, missing_pages = [], []
+    for page_key in plan:
+        if page_key.isdigit() and str(int(page_key)) == page_key and int(page_key) < page_count:
+            pages.append(int(page_key))
+        else:
+            missing_pages.append(page_key)
+    return sorted(pages), missing_pages
+
+
+# page.search_for не различает регистр только у латинских букв A-Z
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def fold_case(text):
+    """Приводит к нижнему регистру только латинские буквы, как page.search_for."""
+    return text.translate(ASCII_LOWER)
+
+
+def build_word_index(textpage):
+    """
+    Строит индекс слов страницы за один проход по текстовому слою.
+
+    :param textpage: Текстовый слой страницы
+    :return: Словарь {нормализованное слово (см. fold_case): [прямоугольники
+        в порядке следования на странице]} и строка всех слов через перевод строки
+    """
+    words = textpage.extractWORDS()
+    index = {}
+    for x0, y0, x1, y1, word, *_ in words:
+        index.setdefault(fold_case(word), []).append(fitz.Rect(x0, y0, x1, y1))
+    joined = "\n".join(fold_case(word[4]) for word in words)
+    return index, joined
+
+
+def find_hits(page, textpage, word_index, raw_text):
+    """
+    Возвращает все совпадения текста на странице в порядке page.search_for.
+
+    Значение из одного слова берётся из индекса, если на странице оно
+    встречается только целыми словами. Значения с пробелами и значения,
+    которые встречаются внутри других слов, ищутся через page.search_for.
+    """
+    index, joined = word_index
+    key = fold_case(str(raw_text))
+    if key.split() == [key]:
+        rects = index.get(key, [])
+        if joined.count(key) == len(rects):
+            return list(rects)
+    with span("search_for"):
+        return page.search_for(raw_text, textpage=textpage)
+
+
+# Шрифты CJK, для которых insert_textbox считает ширину символа равной 1
+CJK_ORDERINGS = {
+    "Fangti": 0, "Ming": 0, "Heiti": 1, "Song": 1,
+    "Gothic": 2, "Mincho": 2, "Dotum": 3, "Batang": 3,
+}
+
+
+class FontCache:
+    """
+    Кэш шрифтов документа для вставки нового текста.
+
+    Шрифт страницы определяется один раз на страницу, fitz.Font, метрики
+    и таблица ширин глифов — один раз на xref шрифта, ширины строк
+    запоминаются по (xref, размер, текст). Метрики и ширины считаются по тем
+    же данным, по которым insert_textbox проверяет, помещается ли текст.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._page_fonts = {}  # номер страницы -> (имя шрифта, xref)
+        self._glyphs = {}      # xref -> таблица (глиф, ширина)
+        self._infos = {}       # xref -> метрики шрифта или None
+        self._widths = {}      # (xref, размер, текст) -> ширина
+
+    def page_font(self, page):
+        """Возвращает имя и xref шрифта для нового текста на странице."""
+        if page.number not in self._page_fonts:
+            font = page.get_fonts()[1]
+            self._page_fonts[page.number] = (font[4], font[0])
+        return self._page_fonts[page.number]
+
+    def font_info(self, xref):
+        """
+        Возвращает словарь метрик шрифта: font (fitz.Font или None, если шрифт
+        не встроен в документ), ascender, descender, simple, ordering.
+
+        Если шрифт не удалось прочитать, возвращает None.
+        """
+        if xref not in self._infos:
+            try:
+                self._infos[xref] = self._load_info(xref)
+            except Exception:
+                self._infos[xref] = None
+        return self._infos[xref]
+
+    def _load_info(self, xref):
+        # Метрики определяются так же, как PyMuPDF определяет их для insert_textbox
+        name, ext, font_type, buffer = self.doc.extract_font(xref)
+        if ext == "":
+            raise ValueError(f"xref {xref} is not a font")
+        font = None
+        if buffer:
+            font = fitz.Font(fontbuffer=buffer)
+        elif ext != "n/a":
+            font = fitz.Font(name)
+
+        if font is None:
+            # Шрифт не встроен: значения PyMuPDF по умолчанию
+            ascender, descender = 0.8 * 1.2, -0.2 * 1.2
+        else:
+            ascender, descender = font.ascender, font.descender
+            if buffer and ascender - descender < 1:
+                descender = min(descender, font.bbox.y0)
+                ascender = 1 - descender
+        return {
+            "font": font,
+            "ascender": ascender,
+            "descender": descender,
+            "simple": font_type in ("Type1", "MMType1", "TrueType"),
+            "ordering": CJK_ORDERINGS.get(name, -1),
+        }
+
+    def text_width(self, xref, fontsize, text):
+        """Возвращает ширину строки так же, как её считает insert_textbox."""
+        key = (xref, fontsize, text)
+        if key not in self._widths:
+            info = self.font_info(xref)
+            if info["ordering"] >= 0:
+                width = len(text) * fontsize
+            else:
+                if info["simple"]:
+                    text = "".join(c if ord(c) < 256 else "?" for c in text)
+                limit = max(map(ord, text), default=0) + 1
+                if len(self._glyphs.get(xref, ())) < limit:
+                    self._glyphs[xref] = self.doc.get_char_widths(xref, limit)
+                glyphs = self._glyphs[xref]
+                width = sum(glyphs[ord(c)][1] for c in text) * fontsize
+            self._widths[key] = width
+        return self._widths[key]
+
+    def fit_rect(self, xref, fontsize, text, rect):
+        """
+        Расширяет прямоугольник влево и вниз ровно настолько, чтобы текст
+        поместился. Если текст уже помещается, прямоугольник не меняется,
+        поэтому положение текста с выравниванием вправо остаётся прежним.
+        Если шрифт не удалось прочитать, прямоугольник тоже не меняется,
+        и insert_textbox проверяет размер текста сам.
+        """
+        info = self.font_info(xref)
+        if info is None:
+            return fitz.Rect(rect)
+        lines = text.splitlines() or [""]
+        width = max(self.text_width(xref, fontsize, line) for line in lines)
+
+        ascender, descender = info["ascender"], info["descender"]
+        line_height = fontsize * (ascender - descender if ascender - descender > 1 else 1.2)
+        height = line_height * len(lines) - descender * fontsize
+
+        x0, y0, x1, y1 = rect
+        # Небольшой запас, чтобы округление не мешало проверке в insert_textbox
+        if x1 - x0 < width:
+            x0 = x1 - width - 0.01
+        if y1 - y0 < height:
+            y1 = y0 + height + 0.01
+        return fitz.Rect(x0, y0, x1, y1)
+
+
+def redact_text_on_page(page, page_plan, fonts=None):
+    """
+    Заменяет текст на указанной странице документа.
+
+    Сначала собираются все области для замены, затем они удаляются
+    одним вызовом apply_redactions, и только после этого вставляется
+    новый текст. Так содержимое страницы перезаписывается один раз,
+    а не после каждого совпадения.
+
+    :param page: Объект страницы документа
+    :param page_plan: Список пар (старое значение, [новые значения]) для страницы
+    :param fonts: FontCache документа; если не передан, создаётся для страницы
+    :return: Количество замен и количество новых значений, для которых
+        не нашлось совпадения
+    """
+    # Параметры для редактирования
+    new_width = -0.1    # Новая ширина прямоугольника
+    new_width_2 = -14   # Новая ширина прямоугольника
+    new_height = -1.1   # Новая высота прямоугольника
+    new_height_2 = -0.85   # Новая высота прямоугольника
+
+    # Пока идёт поиск, страница не меняется — текстовый слой и индекс слов
+    # строим один раз
+    with span("text_layer"):
+        textpage = page.get_textpage(flags=SEARCH_FLAGS)
+        word_index = build_word_index(textpage)
+
+    replacements = []  # Пары (найденная область, новый текст)
+    claimed = []  # Координаты уже занятых областей
+    misses = 0
+    for raw_text, new_values in page_plan:
+        # Поиск всех совпадений старого текста на странице
+        hits = find_hits(page, textpage, word_index, raw_text)
+
+        # Совпадения внутри текста, уже занятого предыдущими значениями
+        # (например, "2.50" внутри "12.50"), раньше удалялись до поиска —
+        # отбрасываем их, чтобы сохранить прежний результат
+        if claimed:
+            hits = [
+                rect for rect in hits
+                if not any(
+                    x0 < (rect.x0 + rect.x1) / 2 < x1 and y0 < (rect.y0 + rect.y1) / 2 < y1
+                    for x0, y0, x1, y1 in claimed
+                )
+            ]
+
+        for rect, new_text in zip(hits, new_values):
+            replacements.append((rect, new_text))
+            claimed.append(tuple(rect))
+        misses += max(len(new_values) - len(hits), 0)
+
+    if not replacements:
+        return 0, misses
+
+    # Удаляем весь старый текст страницы за один проход
+    with span("apply_redactions"):
+        for rect, _ in replacements:
+            page.add_redact_annot(rect)  # Добавляем аннотацию редактирования
+        page.apply_redactions()     # Применяем редактирование
+
+    if fonts is None:
+        fonts = FontCache(page.parent)
+    fontname, font_xref = fonts.page_font(page)
+    fontsize = 7.86  # Размер шрифта
+
+    # Весь новый текст пишется в один блок содержимого страницы
+    start = time.perf_counter()
+    shape = page.new_shape()
+    for rect, new_text in replacements:
+        # Вычисление новых координат
+        x1, y1, x2, y2 = rect
+        new_x1 = x1 + new_width_2
+        new_x2 = x2 + new_width
+        new_y2 = y2 - new_height_2 * 1.1
+        new_y1 = y1 + new_height
+        new_rect = fonts.fit_rect(
+            font_xref, fontsize, new_text, (new_x1, new_y1, new_x2, new_y2)
+        )
+
+        # Вставка нового текста
+        shape.insert_textbox(
+            new_rect,
+            new_text,
+            fontsize=fontsize,        # Размер шрифта
+            fontname=fontname,
+            align=fitz.TEXT_ALIGN_RIGHT,  # Выравнивание текста
+            color=(0, 0, 0)           # Цвет текста (черный)
+        )
+    shape.commit()
+    add_span("insert_text", time.perf_counter() - start)
+    return len(replacements), misses
+
+
+def redact_pages(doc, plan, pages, on_page=None):
+    """
+    Заменяет текст на указанных страницах документа.
+
+    :param pages: Индексы страниц, которые есть в плане и в документе
+    :param on_page: Функция без аргументов, которая вызывается после каждой
+        страницы, или None; исключение из неё прерывает обработку
+    :return: Счётчики: затронуто страниц, замен, ненайденных значений
+    """
+    fonts = FontCache(doc)
+    counts = {"pages_touched": 0, "hits": 0, "misses": 0}
+    for page_number in pages:
+        hits, misses = redact_text_on_page(doc[page_number], plan[str(page_number)], fonts)
+        counts["pages_touched"] += hits > 0
+        counts["hits"] += hits
+        counts["misses"] += misses
+        count("pages_processed")
+        count("pages_touched", int(hits > 0))
+        count("hits", hits)
+        count("misses", misses)
+        if on_page is not None:
+            on_page()
+    return counts
+
+
+def save_pdf(doc, spill_threshold=None, save_profile=DEFAULT_SAVE_PROFILE, spill_dir=None):
+    """
+    Сохраняет и закрывает документ.
+
+    :param spill_threshold: Если задан, документ сохраняется во временный файл;
+        результат не больше этого числа байт читается обратно в память,
+        а файл удаляется
+    :param save_profile: Имя профиля из SAVE_PROFILES
+    :param spill_dir: Каталог временных файлов или None для системного
+    :return: Содержимое PDF (bytes) или путь к временному файлу (str)
+        и статистика сохранения
+    """
+    profile = SAVE_PROFILES[save_profile]
+    start = time.perf_counter()
+    try:
+        if profile["subset_fonts"]:
+            doc.subset_fonts()
+
+        if spill_threshold is None:
+            buffer = BytesIO()
+            doc.save(buffer, **profile["save"])
+            output = buffer.getvalue()
+            output_bytes = len(output)
+        else:
+            # Размер результата заранее не известен, поэтому документ сразу
+            # пишется на диск и в память читается, только если он небольшой
+            fd, output = tempfile.mkstemp(prefix="edit_pdf_", suffix=".pdf", dir=spill_dir)
+            os.close(fd)
+            try:
+                doc.save(output, **profile["save"])
+                output_bytes = os.path.getsize(output)
+                if output_bytes <= spill_threshold:
+                    with open(output, "rb") as f:
+                        data = f.read()
+                    os.remove(output)
+                    output = data
+            except BaseException:
+                if os.path.exists(output):
+                    os.remove(output)
+                raise
+    finally:
+        doc.close()
+
+    stats = {
+        "save_profile": save_profile,
+        "save_seconds": time.perf_counter() - start,
+        "output_bytes": output_bytes,
+    }
+    add_span("doc_save", stats["save_seconds"])
+    count("bytes_written", stats["output_bytes"])
+    return output, stats
+
+
+def redact_pdf(pdf_bytes, plan, spill_threshold=None, save_profile=DEFAULT_SAVE_PROFILE,
+               on_page=None, spill_dir=None):
+    """
+    Обрабатывает PDF целиком: заменяет текст на всех страницах плана.
+
+    :param pdf_bytes: Содержимое исходного PDF
+    :param plan: План замен, см. build_redaction_plan
+    :param spill_threshold: Если обработанный PDF больше этого числа байт,
+        он остаётся во временном файле, см. save_pdf
+    :param save_profile: Имя профиля из SAVE_PROFILES
+    :param on_page: См. redact_pages
+    :param spill_dir: См. save_pdf
+    :return: Обработанный PDF (см. save_pdf), список страниц плана, которых нет
+        в документе, и статистика обработки (время, размер, счётчики redact_pages)
+    """
+    start = time.perf_counter()
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+    pages, missing_pages = split_plan_pages(plan, len(doc))
+    try:
+        counts = redact_pages(doc, plan, pages, on_page)
+    except BaseException:
+        # Обработку прервали (например, отменой задания) — документ больше не нужен
+        doc.close()
+        raise
+
+    output, stats = save_pdf(doc, spill_threshold, save_profile, spill_dir)
+    stats.update(counts)
+    stats["total_seconds"] = time.perf_counter() - start
+    return output, missing_pages, stats
+
+
+def can_shard(doc):
+    """
+    Можно ли обрабатывать документ частями.
+
+    Части собираются вставкой страниц (см. merge_pdf_pages), при которой
+    теряются внутренние ссылки, а пункты оглавления и поля форм перестают
+    указывать на страницы. Такие документы обрабатываются целиком.
+    """
+    if doc.get_toc(simple=True) or doc.is_form_pdf:
+        return False
+    return not any(page.first_link for page in doc)
+
+
+def redact_pdf_pages(pdf_bytes, plan, pages):
+    """
+    Обрабатывает часть страниц PDF для параллельной обработки одного документа.
+
+    :param pages: Отсортированный список индексов страниц этой части
+    :return: PDF, в котором остались только обработанные страницы, в порядке
+        pages, и счётчики redact_pages
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    counts = redact_pages(doc, plan, pages)
+    doc.select(pages)
+    part = doc.tobytes(garbage=1)
+    doc.close()
+    return part, counts
+
+
+def merge_pdf_pages(pdf_bytes, parts, spill_threshold=None, save_profile=DEFAULT_SAVE_PROFILE,
+                    spill_dir=None):
+    """
+    Собирает документ из исходного PDF и обработанных частей.
+
+    :param parts: Список пар (индексы страниц, результат redact_pdf_pages)
+    :param spill_threshold: См. redact_pdf
+    :param spill_dir: См. save_pdf
+    :return: Итоговый PDF и статистика сохранения (см. save_pdf) с суммой
+        счётчиков частей
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    counts = {"pages_touched": 0, "hits": 0, "misses": 0}
+    for pages, (part_bytes, part_counts) in parts:
+        for name, value in part_counts.items():
+            counts[name] += value
+        part = fitz.open(stream=part_bytes, filetype="pdf")
+        for k, page_number in enumerate(pages):
+            # Вставляем обработанную страницу перед исходной и удаляем исходную
+            doc.insert_pdf(part, from_page=k, to_page=k, start_at=page_number)
+            doc.delete_page(page_number + 1)
+        part.close()
+
+    output, stats = save_pdf(doc, spill_threshold, save_profile, spill_dir)
+    stats.update(counts)
+    return output, stats
+
+
+def iter_process_batch(jobs, workers=1, shard_size=None, cache=None, params=None,
+                       spill_threshold=None, save_profile=DEFAULT_SAVE_PROFILE, on_page=None,
+                       spill_dir=None):
+    """
+    Обрабатывает несколько PDF с учётом кэша и отдаёт результаты по мере готовности.
+
+    Одинаковые пары (PDF, план) обрабатываются один раз, а результаты,
+    которые уже есть в кэше, только хэшируются и не пересчитываются.
+    Результаты, сохранённые во временные файлы, в кэш не попадают.
+
+    :param jobs: Список пар (содержимое PDF, план замен)
+    :param workers: Количество процессов
+    :param shard_size: См. iter_jobs
+    :param cache: Экземпляр cache.ByteLRUCache или None
+    :param params: Параметры обработки, входящие в ключ кэша
+    :param spill_threshold: См. redact_pdf
+    :param save_profile: Имя профиля из SAVE_PROFILES
+    :param on_page: См. iter_jobs
+    :param spill_dir: См. save_pdf
+    :return: Генератор пар (индекс задания, (обработанный PDF, отсутствующие
+        страницы, статистика)); у результатов из кэша в статистике cached=True
+    """
+    params = {**(params or {}), "save_profile": save_profile}
+
+    # Индексы заданий для каждого уникального ключа в порядке первого появления
+    indices = {}
+    for index, (pdf_bytes, plan) in enumerate(jobs):
+        indices.setdefault(result_key(pdf_bytes, plan, params), []).append(index)
+
+    pending = []  # ключи, которые нужно посчитать
+    for key, key_indices in indices.items():
+        cached = cache.get(key) if cache is not None else None
+        if cached is None:
+            pending.append(key)
+            continue
+        output, missing_pages, stats = cached
+        count("cache_hits", len(key_indices))
+        for index in key_indices:
+            yield index, (output, missing_pages, {**stats, "cached": True})
+
+    computed = iter_jobs(
+        [jobs[indices[key][0]] for key in pending],
+        workers=workers, shard_size=shard_size, spill_threshold=spill_threshold,
+        save_profile=save_profile, on_page=on_page, spill_dir=spill_dir
+    )
+    for key, result in zip(pending, computed):
+        result[2]["cached"] = False
+        if cache is not None and isinstance(result[0], bytes):
+            cache.put(key, result, len(result[0]))
+        for index in indices[key]:
+            yield index, result
+
+
+def iter_jobs(jobs, workers=1, shard_size=None, spill_threshold=None,
+              save_profile=DEFAULT_SAVE_PROFILE, on_page=None, return_exceptions=False,
+              spill_dir=None):
+    """
+    Обрабатывает несколько PDF, при workers > 1 — в пуле процессов.
+
+    В пуле одновременно находится не больше 2 * workers документов, чтобы
+    готовые результаты не копились в памяти. Если генератор закрыт раньше
+    времени, документы, которые ещё не начали обрабатываться, отменяются,
+    а временные файлы уже готовых, но не выданных результатов удаляются.
+
+    :param jobs: Список пар (содержимое PDF, план замен)
+    :param workers: Количество процессов
+    :param shard_size: Если задано, документы, в плане которых больше страниц,
+        делятся на части по shard_size страниц между процессами; документы
+        с оглавлением, ссылками или формами обрабатываются целиком (см. can_shard)
+    :param spill_threshold: См. redact_pdf
+    :param save_profile: Имя профиля из SAVE_PROFILES
+    :param on_page: См. redact_pages; вызывается только без пула процессов
+    :param return_exceptions: Вместо результата документа, который не удалось
+        обработать, выдавать исключение и продолжать обработку остальных
+    :param spill_dir: См. save_pdf
+    :return: Генератор результатов redact_pdf в порядке jobs
+    """
+    if workers <= 1:
+        for pdf_bytes, plan in jobs:
+            try:
+                result = redact_pdf(
+                    pdf_bytes, plan, spill_threshold, save_profile, on_page, spill_dir
+                )
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                result = e
+            yield result
+        return
+
+    # Если замеры включены, процессы пула возвращают и свои замеры
+    trace = current_trace()
+
+    def submit(func, *args):
+        if trace is None:
+            return pool.submit(func, *args)
+        return pool.submit(run_traced, func, *args)
+
+    def result_of(future):
+        if trace is None:
+            return future.result()
+        result, worker_trace = future.result()
+        trace.merge(worker_trace)
+        return result
+
+    def collect(entry):
+        try:
+            if isinstance(entry, tuple):
+                # Документ обрабатывался частями — собираем его в основном процессе
+                pdf_bytes, parts, missing_pages, start = entry
+                parts = [(shard, result_of(future)) for shard, future in parts]
+                output, stats = merge_pdf_pages(
+                    pdf_bytes, parts, spill_threshold, save_profile, spill_dir
+                )
+                stats["total_seconds"] = time.perf_counter() - start
+                return output, missing_pages, stats
+            return result_of(entry)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return e
+
+    def discard(entry):
+        # Готовый результат, который никто не заберёт: удаляем его временный файл
+        if isinstance(entry, tuple) or not entry.done() or entry.cancelled():
+            return
+        if entry.exception() is not None:
+            return
+        result = entry.result() if trace is None else entry.result()[0]
+        if isinstance(result[0], str) and os.path.exists(result[0]):
+            os.remove(result[0])
+
+    context = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    pending = deque()
+    try:
+        for pdf_bytes, plan in jobs:
+            pages = []
+            if shard_size:
+                try:
+                    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                        if can_shard(doc):
+                            pages, missing_pages = split_plan_pages(plan, len(doc))
+                except Exception:
+                    # Повреждённый документ обрабатывается целиком, ошибку вернёт процесс пула
+                    if not return_exceptions:
+                        raise
+
+            if shard_size and len(pages) > shard_size:
+                parts = [
+                    (shard, submit(redact_pdf_pages, pdf_bytes, plan, shard))
+                    for shard in (pages[i:i + shard_size] for i in range(0, len(pages), shard_size))
+                ]
+                pending.append((pdf_bytes, parts, missing_pages, time.perf_counter()))
+            else:
+                pending.append(
+                    submit(redact_pdf, pdf_bytes, plan, spill_threshold, save_profile, None, spill_dir)
+                )
+
+            while len(pending) >= 2 * workers:
+                yield collect(pending.popleft())
+
+        while pending:
+            yield collect(pending.popleft())
+    finally:
+        # При досрочном закрытии генератора незапущенные документы не нужны
+        pool.shutdown(wait=True, cancel_futures=True)
+        for entry in pending:
+            discard(entry)
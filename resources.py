@@ -0,0 +1,77 @@
+"""
+Общие для страниц ресурсы Streamlit.
+
+Страницы — отдельные модули, а очередь заданий и реестр сессий должны быть
+одни на всё приложение, поэтому они и функции работы с ними определены здесь.
+"""
+
+import getpass
+import os
+import tempfile
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from cache import SessionRegistry
+from jobs import JobQueue
+
+
+# Ключи st.session_state со словарями крупных данных обеих страниц,
+# которые освобождаются, когда сессия простаивает
+SESSION_STORES = (
+    "excel_sheets", "page1_ingest", "page1_json", "page1_export", "new_create_time_state",
+    "page1_traces", "mapping_tables", "page2_job",
+)
+
+
+@st.cache_resource
+def get_job_queue():
+    """
+    Очередь фоновых заданий, общая для обеих страниц.
+
+    Число одновременно выполняемых заданий задаётся переменной окружения
+    EDIT_PDF_JOB_WORKERS, время хранения результатов — EDIT_PDF_JOB_TTL_MIN,
+    общее число процессов в пулах заданий — EDIT_PDF_JOB_PROCESSES
+    (по умолчанию число процессоров), каталог временных файлов заданий —
+    EDIT_PDF_JOB_DIR (по умолчанию edit_pdf_jobs_<пользователь> во временном
+    каталоге системы). Каталог очищается при создании очереди, поэтому он
+    не должен быть общим для нескольких серверов.
+    """
+    work_dir = os.environ.get("EDIT_PDF_JOB_DIR") or os.path.join(
+        tempfile.gettempdir(), f"edit_pdf_jobs_{getpass.getuser()}"
+    )
+    return JobQueue(
+        max_workers=int(os.environ.get("EDIT_PDF_JOB_WORKERS", 2)),
+        ttl_seconds=int(os.environ.get("EDIT_PDF_JOB_TTL_MIN", 60)) * 60,
+        max_processes=int(os.environ.get("EDIT_PDF_JOB_PROCESSES", 0)) or None,
+        work_dir=work_dir,
+    )
+
+
+@st.cache_resource
+def get_session_registry():
+    """
+    Общий реестр сессий: данные сессии, простаивающей дольше
+    EDIT_PDF_SESSION_IDLE_MIN минут, освобождаются.
+    """
+    return SessionRegistry(
+        idle_seconds=int(os.environ.get("EDIT_PDF_SESSION_IDLE_MIN", 60)) * 60
+    )
+
+
+def session_stores():
+    """Словари сессии, которые освобождаются при простое."""
+    return [st.session_state.get(key) for key in SESSION_STORES]
+
+
+def touch_session(stores=None):
+    """
+    Отмечает активность сессии на любой странице.
+
+    :param stores: Словари сессии с крупными данными, см. session_stores
+    :return: True, если данные сессии были освобождены с прошлого раза
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return False
+    return get_session_registry().touch(ctx.session_id, stores)
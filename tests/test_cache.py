@@ -0,0 +1,31 @@
+import os
+import pickle
+import stat
+
+from cache import ByteLRUCache
+
+
+class Exploit:
+    def __reduce__(self):
+        return (os.mkdir, ("pwned",))
+
+
+def test_disk_tier_round_trips_result(tmp_path):
+    cache = ByteLRUCache(max_bytes=1024, disk_dir=str(tmp_path / "cache"))
+    result = (b"%PDF-1.7 ...", ["5"], {"hits": 1, "total_seconds": 0.25})
+    cache.put(("key", 1), result, len(result[0]))
+    cache.clear()
+
+    assert cache.get(("key", 1)) == result
+    assert cache.stats()["bytes"] == len(result[0])
+    assert stat.S_IMODE(os.stat(tmp_path / "cache").st_mode) == 0o700
+
+
+def test_disk_tier_does_not_unpickle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ByteLRUCache(max_bytes=1024, disk_dir=str(tmp_path / "cache"))
+    with open(cache._disk_path("key"), "wb") as f:
+        pickle.dump(Exploit(), f)
+
+    assert cache.get("key", "miss") == "miss"
+    assert not (tmp_path / "pwned").exists()
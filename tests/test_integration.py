@@ -0,0 +1,256 @@
+import random
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from integration import (
+    ROUNDING_COLUMNS, build_conc_lookup, build_value_table, compact_sheet, fill_create_times,
+    format_columns, match_new_conc, parse_times,
+)
+
+
+def old_fill_create_times(create_time, new_create_time, first_hour):
+    """Прежний построчный пересчёт newCreate_time со страницы Page1."""
+    result = list(new_create_time)
+    invalid_rows = []
+    for i in range(1, len(create_time)):
+        try:
+            prev_time = datetime.strptime(str(create_time[i - 1]), "%H:%M:%S")
+            curr_time = datetime.strptime(str(create_time[i]), "%H:%M:%S")
+            time_difference = curr_time - prev_time
+            prev_time = prev_time.replace(hour=first_hour)
+            result[i] = (prev_time + time_difference).time().strftime("%H:%M:%S")
+        except ValueError:
+            invalid_rows.append(i)
+    return result, invalid_rows
+
+
+def random_time(rng):
+    if rng.random() < 0.15:
+        return rng.choice([
+            "", "24:00:00", "12:60:00", "1:2:3", "07:05", "abc", None,
+            "١٢:٠٠:٠٠", "٩:٥:٧", "1٢:30:00",
+        ])
+    return f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fill_create_times_matches_old_logic(seed):
+    rng = random.Random(seed)
+    create_time = pd.Series([random_time(rng) for _ in range(200)])
+    new_create_time = pd.Series(["08:00:00"] + [""] * 199)
+    first_hour = rng.randrange(24)
+
+    values, invalid_rows = fill_create_times(create_time, new_create_time, first_hour)
+    expected, expected_invalid = old_fill_create_times(create_time, new_create_time, first_hour)
+    assert values.tolist() == expected
+    assert invalid_rows == expected_invalid
+
+
+def test_non_ascii_digits_are_read_like_strptime():
+    # strptime принимает "٩:٥:٧" как 09:05:07, а "١٢:٠٠:٠٠" — нет
+    create_time = pd.Series(["10:00:00", "١٢:٠٠:٠٠", "10:30:00", "٩:٥:٧", "11:00:00"])
+    new_create_time = pd.Series(["14:00:00", "", "", "", ""])
+
+    seconds = parse_times(create_time)
+    assert pd.isna(seconds[1])
+    assert seconds[3] == 9 * 3600 + 5 * 60 + 7
+
+    values, invalid_rows = fill_create_times(create_time, new_create_time, 14)
+    assert invalid_rows == [1, 2]
+    assert values.tolist() == ["14:00:00", "", "", "13:05:07", "16:00:00"]
+
+
+def old_match_new_conc(sample_names, json_df):
+    """Прежний поиск newConc: первый идентификатор, которым оканчивается имя образца."""
+    json_df = json_df.copy()
+    json_df["Identifier"] = json_df.apply(
+        lambda x: f"-{x['Subject']}-{x['Period']}-{str(int(x['timePoint']) - 1).zfill(2)}",
+        axis=1
+    )
+    id_to_conc = dict(zip(json_df["Identifier"], json_df["CalcConc"]))
+    return sample_names.apply(
+        lambda x: next((value for key, value in id_to_conc.items() if x.endswith(key)), "")
+    ).tolist()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_new_conc_matches_old_logic(seed):
+    rng = random.Random(seed)
+    # Субъекты с "-" внутри дают идентификаторы из большего числа частей,
+    # и имя образца может оканчиваться сразу несколькими идентификаторами
+    subjects = ["1", "2", "11", "A-1", "B-1-1", "1-1", "007"]
+    json_df = pd.DataFrame([
+        {
+            "Subject": rng.choice(subjects), "Period": rng.choice([1, 2, "1-2"]),
+            "timePoint": rng.randrange(1, 14),
+            "CalcConc": rng.choice([0, 1.5, 2, "3.25", None, rng.random()]),
+        }
+        for _ in range(60)
+    ])
+    identifiers = [
+        f"-{row.Subject}-{row.Period}-{row.timePoint - 1:02d}" for row in json_df.itertuples()
+    ]
+    sample_names = pd.Series([
+        rng.choice(["S", "Study-X", "QC", "", "S-1", "A"]) + (
+            rng.choice(identifiers) if rng.random() < 0.7
+            else "-" + "-".join(rng.choice(subjects + ["01", "12"]) for _ in range(rng.randrange(1, 5)))
+        )
+        for _ in range(300)
+    ] + ["blank", "-", ""], index=range(100, 403))
+
+    lookup, _ = build_conc_lookup(json_df)
+    values, unmatched = match_new_conc(sample_names, lookup)
+
+    expected = old_match_new_conc(sample_names, json_df)
+    assert values.tolist() == expected
+    assert values.index.equals(sample_names.index)
+    assert unmatched == [name for name, value in zip(sample_names, expected) if value == ""]
+
+
+def old_format_columns(df, settings):
+    """Прежнее округление Page1: apply_rounding и apply_digits по каждому соединению."""
+    def apply_rounding(data, precision):
+        def round_number(x):
+            try:
+                return round(float(x), precision)
+            except ValueError:
+                return x
+        return [round_number(x) for x in data]
+
+    def apply_digits(data, digits):
+        def format_number(x):
+            try:
+                return f"{float(x):.{digits}f}"
+            except ValueError:
+                return x
+        return [format_number(x) for x in data]
+
+    for compound in df["Compound_name"].unique():
+        mask = df["Compound_name"] == compound
+        for column, prefix in ROUNDING_COLUMNS.items():
+            if column in df.columns:
+                df.loc[mask, column] = apply_rounding(
+                    df.loc[mask, column], int(settings.loc[compound, f"{prefix}_rounding"])
+                )
+                df.loc[mask, column] = apply_digits(
+                    df.loc[mask, column], int(settings.loc[compound, f"{prefix}_digits"])
+                )
+
+
+def random_number(rng):
+    choice = rng.random()
+    if choice < 0.1:
+        return rng.choice(["", "abc", "ND", "nan", "inf", "-0", "1e3", " 2.5 ", "0.125", "2.675"])
+    if choice < 0.4:
+        return round(rng.uniform(-1000, 1000), rng.randrange(6))
+    return repr(rng.uniform(0, 100) * 10 ** rng.randrange(-4, 4))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_format_columns_matches_old_logic(seed):
+    rng = random.Random(seed)
+    compounds = ["Cmp1", "Cmp2", "Cmp3", "Cmp4"]
+    columns = ["Response", "Conc", "newResponse", "newConc"]
+    # Одна из колонок округления может отсутствовать в листе
+    present = columns if seed % 2 else columns[:-1]
+    df = pd.DataFrame({
+        "Compound_name": [rng.choice(compounds) for _ in range(400)],
+        **{column: pd.Series([random_number(rng) for _ in range(400)], dtype=object) for column in present},
+    })
+    settings = pd.DataFrame(
+        {
+            f"{prefix}_{kind}": [rng.randrange(0, 6) for _ in compounds]
+            for prefix in ROUNDING_COLUMNS.values() for kind in ("rounding", "digits")
+        },
+        index=compounds,
+    )
+
+    expected = df.copy()
+    old_format_columns(expected, settings)
+    missing = format_columns(df, settings)
+
+    assert missing == [column for column in columns if column not in present]
+    for column in present:
+        assert df[column].tolist() == expected[column].tolist()
+
+
+def old_build_value_table(df, sheet_name, page_inputs):
+    """Прежняя таблица Old Value / New Value / Page со страницы Page1."""
+    filtered_df = df[
+        (df["newConc"].notna()) & (df["newResponse"].notna())
+    ]
+    if filtered_df.empty:
+        return None
+    result_df = pd.DataFrame({
+        "Old Value": list(filtered_df["Response"]) + list(filtered_df["Conc"]) + list(filtered_df["Create_time"]),
+        "New Value": list(filtered_df["newResponse"]) + list(filtered_df["newConc"]) + list(filtered_df["newCreate_time"]),
+        "Page": sum([
+            [
+                page_inputs[(sheet_name, row["Compound_name"])][f"{key}_page"]
+                for _, row in filtered_df.iterrows()
+            ]
+            for key in ["newConc_newResponse", "newConc_newResponse", "newCreate_time"]
+        ], [])
+    })
+    result_df = result_df[
+        result_df["New Value"].notna()
+        & (result_df["New Value"] != "")
+        & (result_df["New Value"].astype(str).str.strip() != "")
+    ]
+    result_df = result_df[
+        result_df["Old Value"].notna()
+        & (result_df["Old Value"] != "")
+        & (result_df["Old Value"].astype(str).str.strip() != "")
+    ]
+    return result_df
+
+
+def random_cell(rng, values):
+    choice = rng.random()
+    if choice < 0.1:
+        return None
+    if choice < 0.2:
+        return rng.choice(["", " ", "  "])
+    return rng.choice(values)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("compact", [False, True])
+def test_build_value_table_matches_old_logic(seed, compact):
+    rng = random.Random(seed)
+    compounds = ["Cmp1", "Cmp2", "Cmp3"]
+    numbers = ["1.25", "0.50", "123.4", "7", "12.50"]
+    times = ["08:15:00", "9:05:07", "23:59:59"]
+    rows = 150
+    df = pd.DataFrame({
+        "Compound_name": [rng.choice(compounds) for _ in range(rows)],
+        "Sample_name": [f"S-{i}" for i in range(rows)],
+        "Create_time": [random_cell(rng, times) for _ in range(rows)],
+        "newCreate_time": [random_cell(rng, times) for _ in range(rows)],
+        "Response": [random_cell(rng, numbers) for _ in range(rows)],
+        "newResponse": [random_cell(rng, numbers) for _ in range(rows)],
+        "Conc": [random_cell(rng, numbers) for _ in range(rows)],
+        "newConc": [random_cell(rng, numbers) for _ in range(rows)],
+    })
+    page_inputs = {
+        ("sheet", compound): {
+            "newConc_newResponse_page": rng.randrange(5), "newCreate_time_page": rng.randrange(5),
+        }
+        for compound in compounds
+    }
+    pages = {compound: page_inputs[("sheet", compound)] for compound in compounds}
+
+    expected = old_build_value_table(df, "sheet", page_inputs)
+    # В сессии листы хранятся в компактном виде, см. compact_sheet
+    result = build_value_table(compact_sheet(df.copy()) if compact else df, pages)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_build_value_table_without_new_values():
+    df = pd.DataFrame({
+        "Compound_name": ["Cmp1"], "Create_time": ["08:00:00"], "newCreate_time": [""],
+        "Response": ["1.0"], "newResponse": [None], "Conc": ["2.0"], "newConc": ["3.0"],
+    })
+    assert build_value_table(df, {"Cmp1": {}}) is None
@@ -0,0 +1,115 @@
+import os
+import random
+
+import fitz
+import pandas as pd
+import pytest
+
+from redaction import (
+    SEARCH_FLAGS, FontCache, build_redaction_plan, build_word_index, find_hits,
+    redact_pdf, redact_text_on_page,
+)
+
+
+def make_page(lines):
+    """Документ из одной страницы со строками текста шрифтом Helvetica."""
+    doc = fitz.open()
+    page = doc.new_page()
+    for number, line in enumerate(lines):
+        page.insert_text((50, 100 + 30 * number), line, fontname="helv")
+    return doc, page
+
+
+@pytest.mark.parametrize("value", [
+    "uni", "UNI", "Uni", "12.50", "2.50", "ünï", "ÜNÏ", "Ünï", "ÜNï", "straße", "STRASSE",
+])
+def test_find_hits_matches_search_for(value):
+    doc, page = make_page(["ünï ÜNÏ Ünï UNI uni", "12.50 2.50 straße STRASSE"])
+    textpage = page.get_textpage(flags=SEARCH_FLAGS)
+    word_index = build_word_index(textpage)
+    assert find_hits(page, textpage, word_index, value) == page.search_for(value, textpage=textpage)
+    doc.close()
+
+
+def test_font_cache_leaves_rect_when_font_is_unreadable(monkeypatch):
+    doc, page = make_page(["12.50"])
+    fonts = FontCache(doc)
+    xref = page.get_fonts()[0][0]
+
+    def broken(xref):
+        raise RuntimeError("broken font")
+
+    monkeypatch.setattr(doc, "extract_font", broken)
+    assert fonts.font_info(xref) is None
+    assert fonts.fit_rect(xref, 7.86, "123456789", (10, 10, 12, 12)) == fitz.Rect(10, 10, 12, 12)
+    doc.close()
+
+
+def old_redact_text_on_page(page, df, page_number):
+    """Прежняя замена со страницы Page2: apply_redactions после каждого совпадения."""
+    df['Page'] = df['Page'].astype(str)
+    df_page = df[df['Page'] == str(page_number)]
+    for raw_text in df_page['Old Value'].unique():
+        df_matches = df_page[df_page['Old Value'] == raw_text]
+        new_values = df_matches['New Value'].values
+        hits = page.search_for(raw_text)
+        for rect, new_text in zip(hits, new_values):
+            x1, y1, x2, y2 = rect
+            new_rect = fitz.Rect(x1 - 14, y1 - 1.1, x2 - 0.1, y2 + 0.85 * 1.1)
+            page.add_redact_annot(rect)
+            page.apply_redactions()
+            page.insert_textbox(
+                new_rect, new_text, fontsize=7.86, fontname=page.get_fonts()[1][4],
+                align=fitz.TEXT_ALIGN_RIGHT, color=(0, 0, 0),
+            )
+
+
+def make_report(rows, pages=2):
+    """Отчёт с заголовком и таблицей значений на каждой странице (на странице два шрифта)."""
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 40), "Sample report", fontname="tiro", fontsize=11)
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                page.insert_text((80 + 110 * c, 70 + 18 * r), value, fontname="helv", fontsize=8)
+    return fitz.open("pdf", doc.tobytes())
+
+
+def test_redact_text_on_page_matches_old_logic():
+    rng = random.Random(1)
+    values = ["12.50", "2.50", "0.125", "08:15:00", "1234.5", "7.00", "ND", "Ünï", "ünï"]
+    rows = [[rng.choice(values) for _ in range(4)] for _ in range(20)]
+    table = pd.DataFrame({
+        "Old Value": [
+            "12.50", "12.50", "2.50", "0.125", "08:15:00", "1234.5", "7.00", "missing", "ünï", "ÜNÏ",
+        ],
+        "New Value": ["13.10", "13.20", "3.75", "0.118", "09:15:00", "1301.7", "6.95", "x", "a", "b"],
+        "Page": [0, 0, 0, 1, 0, 1, 1, 0, 0, 1],
+    })
+    plan = build_redaction_plan(table)
+
+    old, new = make_report(rows), make_report(rows)
+    for number in range(len(old)):
+        old_redact_text_on_page(old[number], table.copy(), number)
+        redact_text_on_page(new[number], plan.get(str(number), []))
+
+    for old_page, new_page in zip(old, new):
+        assert [w[:5] for w in new_page.get_text("words")] == [w[:5] for w in old_page.get_text("words")]
+        assert new_page.get_pixmap().samples == old_page.get_pixmap().samples
+
+
+def test_spill_threshold_compares_output_size(tmp_path):
+    pdf_bytes = make_report([["12.50"]], pages=1).tobytes(garbage=4, deflate=True)
+    plan = build_redaction_plan(pd.DataFrame({"Old Value": ["12.50"], "New Value": ["13.10"], "Page": [0]}))
+    expected, _, _ = redact_pdf(pdf_bytes, plan)
+    assert len(expected) < len(pdf_bytes)
+
+    # Порог между размерами результата и исходника: результат остаётся в памяти
+    output, _, stats = redact_pdf(pdf_bytes, plan, spill_threshold=len(expected), spill_dir=str(tmp_path))
+    assert isinstance(output, bytes) and stats["output_bytes"] == len(output) == len(expected)
+    assert list(tmp_path.iterdir()) == []
+
+    output, _, _ = redact_pdf(pdf_bytes, plan, spill_threshold=len(expected) - 1, spill_dir=str(tmp_path))
+    assert list(tmp_path.iterdir()) == [tmp_path / os.path.basename(output)]
+    assert os.path.getsize(output) == len(expected)